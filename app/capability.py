@@ -0,0 +1,98 @@
+# This module probes which QUERY_MAP keys an inverter answers and the largest chunk of keys it answers within one
+# response frame. the result is cached per model and firmware, the TYP/SWV/BDN of the device, in a json file:
+#   {"20010/224/2004": {"supported": ["ADR", ...], "maxcommands": 16, "probed": "2024-06-04T05:00:00"}}
+# later sessions identify the device with one small query and start from the cached plan
+import os
+import json
+import logging
+from datetime import datetime
+from solarmax import sm13MT2
+
+IDENTITY = ('TYP', 'SWV', 'BDN')
+
+
+# the model key of a decoded identity query, None if the device did not answer all of TYP, SWV and BDN
+def getModel(decoded):
+    if not all(key in decoded for key in IDENTITY):
+        return None
+    return '/'.join(str(int(decoded[key])) if isinstance(decoded[key], float) else str(decoded[key])
+                    for key in IDENTITY)
+
+
+class capabilityProbe:
+    # walks through all keys in chunks, the caller sends each chunk and reports the answer. a chunk without a
+    # valid answer is retried at half the size, a single key without answer is unsupported. the chunk size
+    # left at the end is the largest one the device answered reliably
+
+    def __init__(self, keys=None, maxcommands=20):
+        self.pending = list(keys if keys is not None else sm13MT2.QUERY_MAP.keys())
+        self.size = maxcommands
+        self.supported = []
+        self.unsupported = []
+        self.requests = 0
+        self.failures = 0
+
+    def nextChunk(self):
+        return self.pending[:self.size]
+
+    # decoded are the values of the answer, None if there was no valid one
+    def feed(self, chunk, decoded):
+        self.requests += 1
+        if decoded is None:
+            self.failures += 1
+            if len(chunk) > 1:
+                self.size = len(chunk) // 2
+                return
+            decoded = {}
+        for key in chunk:
+            (self.supported if key in decoded else self.unsupported).append(key)
+        del self.pending[:len(chunk)]
+
+    def isDone(self):
+        return not self.pending
+
+
+class capabilityCache:
+
+    def __init__(self, path='./data/capabilities.json', max_chunk=20, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.path = path
+        self.max_chunk = max_chunk
+        self._models = self._load()
+
+    @classmethod
+    def fromConfig(cls, config, logger='__main__'):
+        section = config['PROBE']
+        return cls(path=section.get('Path', './data/capabilities.json'),
+                   max_chunk=int(section.get('MaxChunk', '20')), logger=logger)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as msg:
+            self.log.warning(f"capability cache {self.path} not readable, probing again: {msg}")
+            return {}
+
+    # (supported keys, max commands per request) of a model, None if it was not probed yet
+    def get(self, model):
+        entry = self._models.get(model)
+        if entry is None:
+            return None
+        return frozenset(entry['supported']), int(entry['maxcommands'])
+
+    # several loggers may share the file, entries written by the others since the start are kept
+    def put(self, model, probe: capabilityProbe):
+        self._models = self._load()
+        self._models[model] = {'supported': probe.supported, 'maxcommands': probe.size,
+                               'probed': datetime.now().isoformat(timespec='seconds')}
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._models, f, indent=1)
+        os.replace(tmp, self.path)  # atomic, a crash leaves the old or the new cache
+        self.log.info(f"probed model {model}: {len(probe.supported)} keys supported, "
+                      f"{len(probe.unsupported)} unsupported {probe.unsupported}, {probe.size} keys per request, "
+                      f"{probe.requests} requests ({probe.failures} without answer)")
@@ -0,0 +1,107 @@
+# This module records the raw request and response frames of an inverter, so that decoding problems can be
+# reproduced and history can be re-derived later with app/replay.py. records are appended to
+#   <path>/<device>.cap        rotated to <device>.cap.1.gz ... <device>.cap.<backups>.gz
+# each record is a little endian header (epoch seconds as double, direction, frame length) and the frame
+import os
+import gzip
+import atexit
+import time
+import shutil
+import struct
+import logging
+
+REQUEST, RESPONSE = 0, 1
+_HEADER = struct.Struct('<dBH')
+
+
+class frameCapture:
+
+    def __init__(self, path='./data/capture', device='default', max_bytes=16 * 1024 * 1024, backups=10,
+                 flush_records=64, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.filename = os.path.join(path, f"{device}.cap")
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_records = flush_records
+        self._pending = 0
+        self.records = 0
+        os.makedirs(path, exist_ok=True)
+        self._file = open(self.filename, 'ab')
+        self._size = self._file.tell()
+        atexit.register(self.close)  # buffered records are written on a normal exit too
+
+    @classmethod
+    def fromConfig(cls, config, device='default', logger='__main__'):
+        section = config['CAPTURE']
+        return cls(path=section.get('Path', './data/capture'), device=device,
+                   max_bytes=int(section.get('MaxFileSizeMB', '16')) * 1024 * 1024,
+                   backups=int(section.get('Backups', '10')),
+                   flush_records=int(section.get('FlushRecords', '64')), logger=logger)
+
+    def record(self, direction, frame, ts=None):
+        self._file.write(_HEADER.pack(ts or time.time(), direction, len(frame)))
+        self._file.write(frame)
+        self._size += _HEADER.size + len(frame)
+        self.records += 1
+        self._pending += 1
+        if self._pending >= self.flush_records:
+            self._file.flush()
+            self._pending = 0
+        if self._size >= self.max_bytes:
+            self._rotate()
+
+    # the frames are ascii and compress well, rotated files are kept gzipped
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.filename}.{i}.gz"
+            if os.path.exists(src):
+                os.replace(src, f"{self.filename}.{i + 1}.gz")
+        if self.backups > 0:
+            with open(self.filename, 'rb') as src, gzip.open(f"{self.filename}.1.gz", 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        os.remove(self.filename)
+        self.log.info(f"rotated frame capture {self.filename}")
+        self._file = open(self.filename, 'ab')
+        self._size = 0
+        self._pending = 0
+
+    # called by the logger after every cycle, so a stopped container loses the running cycle at most
+    def flush(self):
+        if self._pending:
+            self._file.flush()
+            self._pending = 0
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+# yields (epoch seconds, direction, frame) from a capture file, gzipped or not. a torn last record is ignored
+def readCapture(filename):
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as f:
+        data = f.read()
+    view = memoryview(data)
+    i, end = 0, len(data)
+    while i + _HEADER.size <= end:
+        ts, direction, length = _HEADER.unpack_from(view, i)
+        i += _HEADER.size
+        if i + length > end:
+            break
+        yield ts, direction, bytes(view[i:i + length])
+        i += length
+
+
+# the capture files of a device oldest first
+def getCaptureFiles(path, device='default'):
+    base = os.path.join(path, f"{device}.cap")
+    files = []
+    i = 1
+    while os.path.exists(f"{base}.{i}.gz"):
+        files.append(f"{base}.{i}.gz")
+        i += 1
+    files.reverse()
+    if os.path.exists(base):
+        files.append(base)
+    return files
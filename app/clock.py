@@ -0,0 +1,87 @@
+# This module paces the polling and heartbeat loops on deadlines instead of sleeping a fixed time after each
+# cycle, so the cycle duration does not add up to drift. deadlines are kept on the monotonic clock and, for
+# periods that divide a day, aligned to wall clock boundaries (:00, :10, :20, ... for 10 s) so that all loops
+# and inverters sample at the same instants. a cycle that runs past its next deadline skips the missed ticks
+import math
+import time
+import asyncio
+import logging
+import metrics
+
+JITTER_SECONDS = metrics.REGISTRY.histogram('solarmax_clock_jitter_seconds', 'lateness of a loop behind its deadline',
+                                            ['loop'], buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+OVERRUNS = metrics.REGISTRY.counter('solarmax_clock_overruns_total', 'cycles that ran past their next deadline',
+                                    ['loop'])
+SKIPPED_TICKS = metrics.REGISTRY.counter('solarmax_clock_skipped_ticks_total', 'ticks skipped after an overrun',
+                                         ['loop'])
+
+
+class deadlineClock:
+
+    def __init__(self, name='logger', align=True, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.name = name
+        self.align = align
+        self._deadline = None  # monotonic time of the pending tick
+
+        # statistics
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter_last = 0.0
+        self.jitter_max = 0.0
+        self._jitter_sum = 0.0
+
+        self._jitter = JITTER_SECONDS.labels(name)
+        self._overruns = OVERRUNS.labels(name)
+        self._skipped = SKIPPED_TICKS.labels(name)
+
+    def getStats(self):
+        return {'ticks': self.ticks, 'overruns': self.overruns, 'skipped': self.skipped,
+                'jitter_last': round(self.jitter_last, 4), 'jitter_max': round(self.jitter_max, 4),
+                'jitter_mean': round(self._jitter_sum / self.ticks, 4) if self.ticks else 0.0}
+
+    def _isAligned(self, period):
+        return self.align and period >= 1 and 86400 % period == 0
+
+    # the first deadline after base, in monotonic time
+    def _next(self, base, period, offset):
+        if self._isAligned(period):
+            # base is usually the last deadline itself, the slack keeps float noise from landing on it again
+            return (math.floor((base + offset) / period + 1e-3) + 1) * period - offset
+        return base + period
+
+    # plans the next tick period seconds after the last one and returns the seconds to sleep until then
+    def delay(self, period):
+        now = time.monotonic()
+        offset = time.time() - now  # re-read each tick, the wall clock may have been stepped
+        deadline = self._next(self._deadline if self._deadline is not None else now, period, offset)
+
+        if deadline < now:
+            missed = math.ceil((now - deadline) / period) if period > 0 else 0
+            deadline = self._next(now, period, offset)
+            self.overruns += 1
+            self.skipped += missed
+            self._overruns.inc()
+            self._skipped.inc(missed)
+            self.log.warning(f"{self.name} cycle overran its deadline, skipping {missed} tick(s)")
+
+        self._deadline = deadline
+        return deadline - now
+
+    # called after the sleep, records how late the loop woke up
+    def _woke(self):
+        jitter = max(time.monotonic() - self._deadline, 0.0)
+        self.ticks += 1
+        self.jitter_last = jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        self._jitter_sum += jitter
+        self._jitter.observe(jitter)
+
+    def wait(self, period):
+        time.sleep(self.delay(period))
+        self._woke()
+
+    async def waitAsync(self, period):
+        await asyncio.sleep(self.delay(period))
+        self._woke()
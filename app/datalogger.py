@@ -1,8 +1,17 @@
-import json
-from datetime import datetime
-from solarmax import SOLARMAX_DATE_FORMAT, sm13MT2, communication
+from solarmax import sm13MT2, sample
+from session import inverterSession
+from scheduler import pollScheduler
+from deadband import deadbandFilter
+from tsstore import timeSeriesStore
+from sun import sunScheduler
+from rollup import rollupAggregator
+from payload import cyclePayload
+from capture import frameCapture
+from capability import capabilityCache
+from pipeline import createPipeline
 import logging
-import paho.mqtt.client as paho
+import metrics
+from publisher import createPublisher
 from enum import Enum
 
 
@@ -13,43 +22,79 @@ class loggerState(Enum):
     LOGGING_LAST = 4
 
 
-# this function overwrite the response values for momentary parameter to zero, this could be used for additional
-# database entries after inverter goes down
-def _forceZero(data: dict, clear_dailys=False, sdat_overwrite=None):
-    logging.warning(f"forcing to zero, clear_dailies={clear_dailys}, sdat_overwrite={sdat_overwrite}")
-    for key in data:
-        if key in sm13MT2.MOMENTARIES:
-            data[key]['value'] = float(0)
+# pipeline items are (kind, topic, sample), consecutive samples of a topic merge into the newer one
+def coalesceItems(old, new):
+    if old[0] == new[0] == 'sample' and old[1] == new[1]:
+        return 'sample', new[1], old[2].merge(new[2])
+    return None
 
-        if key in sm13MT2.DAILYS and clear_dailys:
-            data[key]['value'] = float(0)
 
-    if sdat_overwrite and 'SDAT' in data.keys():
-        data['SDAT']['value'] = sdat_overwrite
-    return data
+# the bus addresses of an inverter section, Address = 1 or Address = 1,2,3 for several units behind a gateway
+def getAddresses(config, inverter='INVERTER'):
+    return [int(a) for a in config[inverter].get('Address', '1').split(',') if a.strip()]
 
 
 class dataLogger:
 
-    def __init__(self, config, log='__main__'):
+    # inverter names the config section of the polled device, additional devices are configured in
+    # sections [INVERTER:<name>] and may override LogStep and LogStepMax. a section may list several bus
+    # addresses of units behind one gateway, adr selects the unit and its name gets the suffix adr<N>
+    def __init__(self, config, log='__main__', publisher=None, inverter='INVERTER', pipeline=None, adr=None,
+                 history=None):
         self.log = logging.getLogger(log)
         self.conf = config
-        self.step_min = int(config['LOGGER']['LogStep'])
-        self.step_max = int(config['LOGGER']['LogStepMax'])
-        self.waiting_time = int(config['LOGGER']['LogStep'])
-        self.data = dict()
-        self.last_data = dict()
+        self.device_name = inverter.partition(':')[2]
+        addresses = getAddresses(config, inverter)
+        if adr is not None and len(addresses) > 1:
+            self.device_name = f"{self.device_name}-adr{adr}" if self.device_name else f"adr{adr}"
+        self.step_min = int(config[inverter].get('LogStep', config['LOGGER']['LogStep']))
+        self.step_max = int(config[inverter].get('LogStepMax', config['LOGGER']['LogStepMax']))
+        self.waiting_time = self.step_min
+        self.last_sample = None  # all keys seen so far, later samples merged over earlier ones
         self.force_last_to_zero = config['LOGGER']['ForceLastToZero'] == 'True'
         self.test_mode = config['LOGGER']['TestMode'] == 'True'
 
-        self.inverter_ip = config['INVERTER']['IP']
-        self.inverter_port = config['INVERTER']['Port']
-        self.inverter_adr = config['INVERTER']['Address']
+        self.inverter_ip = config[inverter]['IP']
+        self.inverter_port = config[inverter]['Port']
+        self.inverter_adr = adr if adr is not None else addresses[0]
+        self.session = inverterSession(ip=self.inverter_ip, port=self.inverter_port, adr=self.inverter_adr,
+                                       backoff_min=int(config[inverter].get('ReconnectBackoff', '1')),
+                                       backoff_max=int(config[inverter].get('ReconnectBackoffMax', '60')),
+                                       static_ttl=int(config[inverter].get('StaticCacheTTL', '3600')),
+                                       logger=log)
+        # optional probe of the supported keys and the chunk size on the first connect of every model
+        if config.has_section('PROBE') and config['PROBE'].get('Enable', 'False') == 'True':
+            self.session.capabilities = capabilityCache.fromConfig(config, logger=log)
+        if config.has_section('CAPTURE') and config['CAPTURE'].get('Enable', 'False') == 'True':
+            self.session.con.capture = frameCapture.fromConfig(config, device=self.device_name or 'default',
+                                                               logger=log)
 
         self.mqtt_topic = config['MQTT']['TopicPrefix']
         self.mqtt_broker = self.conf['MQTT']['BrokerHostUri']
         self.mqtt_port = int(self.conf['MQTT']['Port'])
         self.mqtt_enable = config['MQTT']['Enable'] == 'True'
+        # optional compact payload, one binary message per cycle on <topic>/cycle next to or instead of per-key json
+        self.per_key_json = config['MQTT'].get('PerKeyJson', 'True') == 'True'
+        self.payload = None
+        if config['MQTT'].get('CyclePayload', 'none') != 'none':
+            self.payload = cyclePayload(config['MQTT']['CyclePayload'], logger=log)
+        self._schema_topic = None
+        self.publisher = publisher
+        if self.mqtt_enable and self.publisher is None:
+            self.publisher = createPublisher(config, logger=log)
+            self.publisher.start()
+        # optional queue between polling and the publish and storage stage, shared by the fleet
+        self.pipeline = pipeline if pipeline is not None else createPipeline(config, coalesceItems, logger=log)
+        self.history = history  # optional history.sampleHistory, shared by all loggers and read over http
+        self.deadband = None
+        if config.has_section('DEADBAND') and config['DEADBAND'].get('Enable', 'False') == 'True':
+            self.deadband = deadbandFilter.fromConfig(config, device=self.device_name or 'default', logger=log)
+        self.store = None
+        if config.has_section('STORE') and config['STORE'].get('Enable', 'False') == 'True':
+            self.store = timeSeriesStore.fromConfig(config, device=self.device_name or 'default', logger=log)
+        self.rollup = None
+        if config.has_section('ROLLUP') and config['ROLLUP'].get('Enable', 'False') == 'True':
+            self.rollup = rollupAggregator.fromConfig(config, device=self.device_name or 'default', logger=log)
         self.count = 0
         self.logger_state = loggerState.UNINITIALIZED
 
@@ -58,44 +103,70 @@ class dataLogger:
         else:
             self.commands = config['LOGGER']['LogQueryList'].split(',')
 
-    def _sendToMQTT(self, topic: str, message: dict):
+        # optional multi-rate polling, the logger then ticks at the scheduler's rate and queries due keys only
+        self.scheduler = None
+        if config.has_section('SCHEDULE') and config['SCHEDULE'].get('Enable', 'False') == 'True':
+            self.scheduler = pollScheduler.fromConfig(config, self.commands, logger=log)
+            self.step_min = self.waiting_time = self.scheduler.tick
+
+        # optional sleep planning from sunrise and sunset, replaces the blind backoff at night
+        self.sun = None
+        if config.has_section('SUN') and config['SUN'].get('Enable', 'False') == 'True':
+            self.sun = sunScheduler.fromConfig(config, logger=log)
+
+    def getTopic(self, device_type):
+        if self.device_name:
+            return f"{self.mqtt_topic}-{device_type}-{self.device_name}"
+        return f"{self.mqtt_topic}-{device_type}"
+
+    def _sendToMQTT(self, topic: str, message: sample):
         if not self.mqtt_enable:
             return
 
-        # message = json.loads(json.dumps(message, sort_keys=True))
-        self.log.debug(f"send to mqtt broker {self.mqtt_broker}:{self.mqtt_port} "
-                       f"topic={self.mqtt_topic} payload={message}")
-
-        def on_publish(client, userdata, result):  # create function for callback
-            # print("data published \n")
-            pass
+        # the compact message always carries the whole cycle, the deadband only thins out the per-key topics
+        if self.payload is not None:
+            if self._schema_topic != topic:
+                self.publisher.setRetained(f"{topic}/schema", self.payload.getSchema(self.commands))
+                self._schema_topic = topic
+            self.publisher.publishPayload(f"{topic}/cycle", self.payload.encode(message))
+        if not self.per_key_json:
+            return
 
-        _client = paho.Client("solarsmart")  # create client object
-        _client.on_publish = on_publish  # assign function to callback
-        _client.connect(self.mqtt_broker, self.mqtt_port)  # establish connection
+        # report by exception, unchanged values are held back until they move out of their deadband
+        if self.deadband is not None:
+            message = self.deadband.filter(message)
+            self.log.debug(f"deadband stats: {self.deadband.getStats()}")
+            if not message:
+                return
 
-        # _timestamp = jsn.get('SDAT').get('value')
-        # _timestamp = datetime.strptime(_timestamp, "%m/%d/%Y, %H:%M:%S").timestamp()
+        self.log.debug(f"send to mqtt broker {self.mqtt_broker}:{self.mqtt_port} "
+                       f"topic={self.mqtt_topic} payload={message}")
 
-        for key in message:
-            datapoint = message.get(key)
-            # datapoint['timestamp'] = _timestamp   # comment out this if extras ts element is desired
-            _client.publish(f"{topic}/{key}", json.dumps(datapoint))  # publish
+        # the whole cycle goes out as one batch over the shared connection, queued while the broker is away
+        self.publisher.publishBatch(topic, message)
+        self.log.debug(f"publisher stats: {self.publisher.getStats()}")
         return
 
-    def _isNewDay(self, data, last_data):
-        now = datetime.strptime(data['SDAT']['value'], SOLARMAX_DATE_FORMAT)
-        if len(self.last_data) > 0:
-            last = datetime.strptime(last_data['SDAT']['value'], SOLARMAX_DATE_FORMAT)
-        else:
+    # closed rollup windows go to <topic>/rollup/<window>, one message per window
+    def _sendRollups(self, topic: str, closed):
+        if not self.mqtt_enable:
+            return
+        for name, message in closed:
+            self.publisher.publish(f"{topic}/rollup/{name}", message, spool=True)
+
+    # SDAT is decoded to a datetime object, no need to parse it back from a string
+    def _isNewDay(self, current, last):
+        if last is None:
             self.log.info('last data still empty')
-            last = now
-        return now == last
+            return False
+        return current.time.date() != last.time.date()
 
     def _increase_waiting_time(self):
         self.waiting_time = self.waiting_time * 2
         if self.waiting_time > self.step_max:
             self.waiting_time = self.step_max  # limit waiting time
+        if self.sun is not None:
+            self.waiting_time = self.sun.getWaitingTime(self.waiting_time)
 
     def _reset_waiting_time(self):
         self.waiting_time = self.step_min
@@ -111,13 +182,25 @@ class dataLogger:
             self.log.info(f"TESTMODE, step {self.count} -> keep status ({status})")
         return status
 
+    def _getCommands(self):
+        if self.scheduler is None:
+            return self.commands
+        return self.scheduler.getDue()
+
     def _query(self, con):
-        status = con.query(self.commands)
+        commands = self._getCommands()
+        status = con.query(commands)
+        self._handleStatus(status, con.getDeviceType(), commands)
 
+    # update backoff and logger state from the result of a query
+    def _handleStatus(self, status, device_type, commands=None):
         if self.test_mode:
             status = self._test_mode(status)
+        last_state = self.logger_state
 
         if status:
+            if self.scheduler is not None and commands is not None:
+                self.scheduler.markPolled(commands)
             self._reset_waiting_time()
             if not self.logger_state == loggerState.LOGGING:
                 self.log.info(f"start logging (last state was: {self.logger_state})")
@@ -125,39 +208,90 @@ class dataLogger:
 
         else:
             self._increase_waiting_time()
-            self.log.info(f"no response from {con.getDeviceType()}, try again in {self.waiting_time} "
+            self.log.info(f"no response from {device_type} at {self.inverter_ip}, try again in {self.waiting_time} "
                              f"seconds (state is: {self.logger_state})")
 
+            # LOGGING_LAST lasts one cycle, so the zero-forced last measurement is published once
             if self.logger_state == loggerState.LOGGING:
                 self.log.warning(f"resend zero-forced last measurement (last state was: {self.logger_state})")
                 self.logger_state = loggerState.LOGGING_LAST
 
-            if self.logger_state == loggerState.UNINITIALIZED or self.logger_state == loggerState.LOGGING_LAST:
+            elif self.logger_state == loggerState.UNINITIALIZED or self.logger_state == loggerState.LOGGING_LAST:
                 self.log.warning(f"change to sleeping state (last state was: {self.logger_state})")
                 self.logger_state = loggerState.SLEEPING
 
+        self._updateMetrics(last_state)
         return
 
-    def logData(self):
-        # establish connection
-        con = communication(ip=self.inverter_ip, port=self.inverter_port, adr=self.inverter_adr)
-
-        # make query and handle response
-        self._query(con)
+    def _updateMetrics(self, last_state):
+        device = self.device_name or 'default'
+        metrics.WAITING_SECONDS.labels(device).set(self.waiting_time)
+        metrics.LOGGER_STATE.labels(device).set(self.logger_state.value)
+        if last_state != self.logger_state:
+            metrics.STATE_TRANSITIONS.labels(device, last_state.name, self.logger_state.name).inc()
 
-        # send data
+    # send data according to the logger state. last_sample merges all samples, so with multi-rate polling the
+    # zero-forced last measurement still carries every key
+    def _publish(self, con):
         if self.logger_state == loggerState.LOGGING:
-            msg = con.decodeddata
-            msg['MOD'] = {'value': 0, 'description': 'non modified'}
-            self._sendToMQTT(message=con.decodeddata, topic=f"{self.mqtt_topic}-{con.getDeviceType()}")
-            # print(msg)
-
-        elif self.logger_state == loggerState.LOGGING_LAST:
-            msg = _forceZero(data=con.decodeddata_last, clear_dailys=False)
-            msg['MOD'] = {'value': 1, 'description': 'momentaries forced to zero'}
-            self._sendToMQTT(message=msg, topic=f"{self.mqtt_topic}-{con.getDeviceType()}")
+            current = con.getSample(self.device_name or 'default')
+            self.last_sample = current if self.last_sample is None else self.last_sample.merge(current)
+            if self.history is not None:
+                self.history.add(self.device_name or 'default', self.last_sample)
+            self._dispatch(('sample', self.getTopic(con.getDeviceType()), current))
+
+        elif self.logger_state == loggerState.LOGGING_LAST and self.last_sample is not None:
+            self.log.warning('forcing momentaries of the last sample to zero')
+            forced = self.last_sample.forceZero()
+            if self.history is not None:
+                self.history.add(self.device_name or 'default', forced)
+            self._dispatch(('forced', self.getTopic(con.getDeviceType()), forced))
 
         else:
             logging.debug('no response from inverter')
 
+    # the frames of the cycle are on disk before the next one starts
+    def _flushCapture(self):
+        if self.session.con.capture is not None:
+            self.session.con.capture.flush()
+
+    # hands the sample to the publish and storage stage, through the pipeline if there is one
+    def _dispatch(self, item):
+        if self.pipeline is not None:
+            self.pipeline.put(self._sink, item)
+        else:
+            self._sink(item)
+
+    # the publish and storage stage, runs in the pipeline's worker if enabled
+    def _sink(self, item):
+        kind, topic, current = item
+        if kind == 'sample':
+            if self.store is not None:
+                self.store.append(current)  # zero-forced samples repeat the last SDAT and are not stored
+            if self.rollup is not None:
+                self._sendRollups(topic, self.rollup.add(current))
+            self._sendToMQTT(message=current, topic=topic)
+        else:
+            self._sendToMQTT(message=current, topic=topic)
+            if self.rollup is not None:
+                self._sendRollups(topic, self.rollup.forceZero())
+
+    # writes what is buffered to disk, called on shutdown after the pipeline has drained
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+        if self.rollup is not None:
+            self.rollup.save()
+        if self.session.con.capture is not None:
+            self.session.con.capture.close()
+
+    def logData(self):
+        with metrics.CYCLE_SECONDS.time():
+            # make query over the session connection, it reconnects lazily if the inverter went away
+            self._query(self.session)
+            self._flushCapture()
+            self.log.debug(f"session stats: {self.session.getStats()}")
+
+            self._publish(self.session.con)
+
         return self.logger_state
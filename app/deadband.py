@@ -0,0 +1,84 @@
+# This module implements report by exception: a value is only published if it moved out of its deadband
+import time
+import logging
+import metrics
+from solarmax import sample
+
+MESSAGES = metrics.REGISTRY.counter('solarmax_deadband_messages_total', 'per-key messages of the deadband filter',
+                                    ['device', 'result'])
+
+
+class deadbandFilter:
+    # keys which only describe the sample, they are published if anything else is
+    CONTEXT = {'SDAT'}
+
+    def __init__(self, absolute=0.0, relative=0.0, max_silence=900, key_bands=None, device='default',
+                 logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.absolute = absolute
+        self.relative = relative
+        self.max_silence = max_silence
+        self.key_bands = key_bands or {}  # key -> (absolute, relative)
+        self._last = {}  # key -> (value, time sent)
+
+        # statistics
+        self.sent = 0
+        self.suppressed = 0
+        self._sent = MESSAGES.labels(device, 'sent')
+        self._suppressed = MESSAGES.labels(device, 'suppressed')
+
+    # a band is either an absolute value (5) or a percentage of the last sent value (2%)
+    @staticmethod
+    def parseBand(s):
+        s = s.strip()
+        if s.endswith('%'):
+            return 0.0, float(s[:-1]) / 100
+        return float(s), 0.0
+
+    @classmethod
+    def fromConfig(cls, config, device='default', logger='__main__'):
+        section = config['DEADBAND']
+        reserved = {'enable', 'absolute', 'relative', 'maxsilence'}
+        # raw, the percent sign would be taken for interpolation otherwise
+        key_bands = {key.upper(): cls.parseBand(value) for key, value in config.items('DEADBAND', raw=True)
+                     if key not in reserved}
+        return cls(absolute=float(section.get('Absolute', '0')), relative=float(section.get('Relative', '0')),
+                   max_silence=int(section.get('MaxSilence', '900')), key_bands=key_bands, device=device,
+                   logger=logger)
+
+    def getStats(self):
+        return {'sent': self.sent, 'suppressed': self.suppressed}
+
+    def _isChanged(self, key, value, last):
+        if not isinstance(value, (int, float)) or not isinstance(last, (int, float)):
+            return value != last
+        absolute, relative = self.key_bands.get(key, (self.absolute, self.relative))
+        delta = abs(value - last)
+        if absolute == 0 and relative == 0:
+            return delta != 0
+        return delta > absolute and delta > relative * abs(last)
+
+    # returns the part of the sample that has to be published, SDAT is kept as context if anything is left
+    def filter(self, message: sample, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        out = []
+        suppressed = self.suppressed
+        for key, value in message.items():
+            if key in self.CONTEXT:
+                continue
+            last = self._last.get(key)
+            if last is None or now - last[1] >= self.max_silence or self._isChanged(key, value, last[0]):
+                self._last[key] = (value, now)
+                out.append(key)
+            else:
+                self.suppressed += 1
+
+        self.sent += len(out)
+        self._sent.inc(len(out))
+        self._suppressed.inc(self.suppressed - suppressed)
+        if not out:
+            return None
+        out.extend(self.CONTEXT)
+        return message.select(out)
@@ -0,0 +1,251 @@
+# This module polls a fleet of inverters concurrently from a single asyncio event loop
+import asyncio
+import time
+import logging
+import metrics
+import capture
+from clock import deadlineClock
+from solarmax import frameReader
+from capability import IDENTITY, getModel, capabilityProbe
+from datalogger import dataLogger, coalesceItems, getAddresses
+from pipeline import createPipeline
+
+
+# all inverters of the config, the default section [INVERTER] and any number of [INVERTER:<name>] sections
+def getInverterSections(config):
+    return [s for s in config.sections() if s == 'INVERTER' or s.startswith('INVERTER:')]
+
+
+# every polled unit as (section, bus address), a section may list several addresses behind one gateway
+def getInverterUnits(config):
+    return [(section, adr) for section in getInverterSections(config) for adr in getAddresses(config, section)]
+
+
+class asyncGateway:
+    # one tcp connection, shared by all units with the same ip and port. the units take turns on the bus,
+    # lock is held for a whole query and hands the connection over in request order
+
+    def __init__(self, ip, port, timeout=5.0, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.ip = ip
+        self.port = int(port)
+        self.timeout = timeout
+        self.lock = None  # created by the fleet inside the event loop, python 3.9 binds it on construction
+        self.frames = frameReader()
+        self.units = []  # asyncInverter, their static caches are dropped on reconnect
+        self._reader = None
+        self._writer = None
+
+    def _isConnected(self):
+        return self._writer is not None and not self._writer.is_closing() and not self._reader.at_eof()
+
+    async def connect(self):
+        if self._isConnected():
+            return True
+        await self.close()
+        try:
+            with metrics.CONNECT_SECONDS.time():
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.ip, self.port), self.timeout)
+            self.log.debug('connected to %s:%i ok' % (self.ip, self.port))
+            for unit in self.units:
+                unit.statics.invalidate()
+                unit.identified = False
+            return True
+        except (OSError, asyncio.TimeoutError) as msg:
+            self.log.debug('connection to %s:%i failed: %s' % (self.ip, self.port, msg))
+            metrics.CONNECT_FAILURES.inc()
+            return False
+
+    async def close(self):
+        self.frames.clear()
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is None:
+            return
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def send(self, frame):
+        with metrics.SEND_SECONDS.time():
+            self._writer.write(frame)
+            await self._writer.drain()
+
+    async def _receive(self):
+        frame = self.frames.nextFrame()
+        while frame is None:
+            data = await self._reader.read(2048)
+            if not data:
+                raise asyncio.IncompleteReadError(b'', None)
+            self.frames.feed(data)
+            frame = self.frames.nextFrame()
+        return frame
+
+    async def receive(self):
+        with metrics.RECEIVE_SECONDS.time():
+            return await asyncio.wait_for(self._receive(), self.timeout)
+
+
+class asyncInverter:
+    # non blocking counterpart of communication.query for one unit, framing and decoding is left to the
+    # communication object, the connection to the gateway
+
+    def __init__(self, logger: dataLogger, gateway: asyncGateway):
+        self.logger = logger
+        self.log = logger.log
+        self.con = logger.session.con
+        self.statics = logger.session.statics
+        self.capabilities = logger.session.capabilities
+        self.identified = False
+        self.gateway = gateway
+        gateway.units.append(self)
+
+    async def _subquery(self, frame, expected):
+        await self.gateway.send(frame)
+        if self.con.capture is not None:
+            self.con.capture.record(capture.REQUEST, frame)
+        for _ in range(self.con.MAX_STALE_FRAMES + 1):
+            response = await self.gateway.receive()
+            if self.con.capture is not None:
+                self.con.capture.record(capture.RESPONSE, response)
+            # a garbled byte fails the checksum instead of raising
+            status = self.con._handleResponse(response.decode('utf8', 'replace'), expected)
+            if status is not None:
+                return status
+        return False
+
+    async def _sendPlan(self, plan):
+        for frame, expected in zip(plan.frames, plan.expected):
+            if not await self._subquery(frame, expected):
+                return False
+        return True
+
+    # counterpart of inverterSession._identify, looks up or probes the capabilities of the connected model
+    async def _identify(self):
+        self.con._beginQuery()
+        if not await self._sendPlan(self.con.getPlan(list(IDENTITY))):
+            return False
+        model = getModel(self.con.decodeddata)
+        self.identified = True
+        if model is None:
+            return True
+        cached = self.capabilities.get(model)
+        if cached is None:
+            probe = capabilityProbe(maxcommands=self.capabilities.max_chunk)
+            while not probe.isDone():
+                chunk = probe.nextChunk()
+                self.con._beginQuery()
+                try:
+                    ok = await self._subquery(self.con._encodeRequest(chunk), frozenset(chunk))
+                except asyncio.TimeoutError:
+                    ok = False
+                probe.feed(chunk, self.con.decodeddata if ok else None)
+                if not ok:
+                    # a late answer must not be taken for the one to the smaller chunk
+                    await self.gateway.close()
+                    if not await self.gateway.connect():
+                        return False
+                    self.identified = True
+            self.capabilities.put(model, probe)
+            cached = self.capabilities.get(model)
+        self.con.setCapabilities(*cached)
+        return True
+
+    # the caller holds the gateway lock
+    async def query(self, commandlist):
+        self.con._beginQuery()
+        if not await self.gateway.connect():
+            return False
+
+        try:
+            if self.capabilities is not None and not self.identified and not await self._identify():
+                await self.gateway.close()
+                return False
+            commands = self.statics.getCommands(commandlist)
+            plan = self.con.getPlan(commands)
+            self.con._beginQuery()
+            if not await self._sendPlan(plan):
+                await self.gateway.close()
+                return False
+        except asyncio.TimeoutError:
+            # a silent unit does not break the connection of the others, a late answer is skipped as stale
+            self.log.debug('no answer from %s:%i address %i' % (self.gateway.ip, self.gateway.port, self.con._adr))
+            if len(self.gateway.units) == 1:
+                await self.gateway.close()
+            return False
+        except (OSError, ValueError, asyncio.IncompleteReadError) as msg:
+            self.log.debug('query to %s:%i address %i failed: %s' % (self.gateway.ip, self.gateway.port,
+                                                                     self.con._adr, msg))
+            await self.gateway.close()
+            return False
+
+        self.con._checkSupported(plan)
+        self.statics.update(commands, self.con.decodeddata)
+        return True
+
+
+class inverterFleet:
+
+    def __init__(self, config, publisher=None, log='__main__', history=None):
+        self.log = logging.getLogger(log)
+        self.max_concurrency = int(config['LOGGER'].get('MaxConcurrency', '8'))
+        timeout = float(config['LOGGER'].get('PollTimeout', '5'))
+
+        # every unit gets its own data logger, so state machine, backoff and topics are kept per device. units
+        # with the same ip and port share one gateway connection
+        self.inverters = {}
+        self.clocks = {}
+        self.gateways = {}
+        align = config['LOGGER'].get('AlignToClock', 'True') == 'True'
+        # one publish and storage worker for all inverters, items of each inverter stay in order
+        self.pipeline = createPipeline(config, coalesceItems, logger=log)
+        if self.pipeline is not None and self.pipeline.policy == 'block':
+            self.pipeline.stop()
+            raise ValueError('pipeline policy block would stall the fleet event loop, use drop_oldest or coalesce')
+        for section, adr in getInverterUnits(config):
+            logger = dataLogger(config=config, log=log, publisher=publisher, inverter=section,
+                                pipeline=self.pipeline, adr=adr, history=history)
+            endpoint = (logger.inverter_ip, int(logger.inverter_port))
+            if endpoint not in self.gateways:
+                self.gateways[endpoint] = asyncGateway(*endpoint, timeout=timeout, logger=log)
+            key = section if len(getAddresses(config, section)) == 1 else f"{section}@{adr}"
+            self.inverters[key] = asyncInverter(logger, self.gateways[endpoint])
+            name = f"logger:{logger.device_name}" if logger.device_name else 'logger'
+            self.clocks[key] = deadlineClock(name, align=align, logger=log)
+        self.log.info(f"fleet of {len(self.inverters)} inverters behind {len(self.gateways)} connections, "
+                      f"max {self.max_concurrency} concurrent polls")
+
+    def getStates(self):
+        return {name: inverter.logger.logger_state.value for name, inverter in self.inverters.items()}
+
+    async def _poll(self, inverter, clock, semaphore, on_cycle):
+        logger = inverter.logger
+        while True:
+            started = time.monotonic()
+            # a failing cycle must not end the polling of this or any other inverter
+            try:
+                commands = logger._getCommands()
+                # the bus of a gateway carries one query at a time, waiting units get it in turn
+                async with inverter.gateway.lock:
+                    async with semaphore:
+                        status = await inverter.query(commands)
+                logger._flushCapture()
+                logger._handleStatus(status, inverter.con.getDeviceType(), commands)
+                logger._publish(inverter.con)
+            except Exception:
+                self.log.exception(f"logging cycle of {logger.device_name or 'default'} failed")
+            metrics.CYCLE_SECONDS.observe(time.monotonic() - started)
+            if on_cycle is not None:
+                on_cycle(self)
+
+            # the next poll of this inverter is due on its next tick, whatever the others do
+            await clock.waitAsync(logger.waiting_time)
+
+    async def run(self, on_cycle=None):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        for gateway in self.gateways.values():
+            gateway.lock = asyncio.Lock()
+        await asyncio.gather(*[self._poll(inverter, self.clocks[key], semaphore, on_cycle)
+                               for key, inverter in self.inverters.items()])
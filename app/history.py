@@ -0,0 +1,103 @@
+# This module keeps the latest sample and a ring buffer of recent samples per inverter in memory and serves them
+# on the http server, so local consumers read the current values without going through the broker:
+#   /latest       {"<device>": {"t": <epoch of SDAT>, "mod": 0, "v": {"PAC": 1234.0, ...}, "added": <epoch>}}
+#   /latest?device=roof&keys=PAC,KDY
+#   /history?device=roof&since=1717477200.5&keys=PAC
+# format=cbor answers in the compact encoding of payload.py instead of json. since refers to "added", the time
+# the logger took the sample, not to SDAT: the zero-forced last sample repeats the SDAT of the one before. every
+# answer carries an ETag, a request with a matching If-None-Match, or with no sample added since, gets 304
+import json
+import time
+import logging
+import threading
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from solarmax import sample
+from payload import getBody, encodeCbor
+
+
+class sampleHistory:
+
+    def __init__(self, size=360, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.size = size
+        self._lock = threading.Lock()
+        self._latest = {}  # device -> (added, sample)
+        self._history = {}  # device -> deque of (added, sample), oldest first
+        self._version = 0  # counts the samples added, the ETag of all answers
+        self._start = int(time.time())  # part of the ETag, so a restart never repeats one
+
+        # statistics
+        self.requests = 0
+        self.not_modified = 0
+
+    @classmethod
+    def fromConfig(cls, config, logger='__main__'):
+        return cls(size=int(config['HTTP'].get('HistorySize', '360')), logger=logger)
+
+    # called by the poll stage with every sample it publishes, zero-forced ones included
+    def add(self, device, current: sample):
+        entry = (round(time.time(), 3), current)  # as served, so since=<added> excludes this one
+        with self._lock:
+            self._latest[device] = entry
+            if device not in self._history:
+                self._history[device] = deque(maxlen=self.size)
+            self._history[device].append(entry)
+            self._version += 1
+
+    # {device: (added, sample)} of the samples added after since
+    def getLatest(self, device=None, since=None):
+        with self._lock:
+            devices = self._latest if device is None else [d for d in (device,) if d in self._latest]
+            return {d: self._latest[d] for d in devices if since is None or self._latest[d][0] > since}
+
+    # {device: [(added, sample), ...]} of the samples added after since
+    def getHistory(self, device=None, since=None):
+        with self._lock:
+            devices = self._history if device is None else [d for d in (device,) if d in self._history]
+            return {d: [e for e in self._history[d] if since is None or e[0] > since] for d in devices}
+
+    def getStats(self):
+        return {'devices': len(self._latest), 'samples': sum(len(h) for h in self._history.values()),
+                'requests': self.requests, 'not_modified': self.not_modified}
+
+    def register(self, server):
+        server.addRoute('/latest', self._latestRoute)
+        server.addRoute('/history', self._historyRoute)
+
+    def _latestRoute(self, request):
+        return self._answer(request, self.getLatest, single=True)
+
+    def _historyRoute(self, request):
+        return self._answer(request, self.getHistory, single=False)
+
+    def _answer(self, request, select, single):
+        self.requests += 1
+        query = parse_qs(urlsplit(request.path).query)
+        device = query.get('device', [None])[0]
+        keys = [k for k in query.get('keys', [''])[0].split(',') if k] or None
+        try:
+            since = float(query['since'][0]) if 'since' in query else None
+        except ValueError:
+            return 400, {'Content-Type': 'text/plain'}, b'since must be epoch seconds\n'
+
+        # read before the data, a sample added in between is reported on the next request
+        etag = f'"{self._start}-{self._version}"'
+        if request.headers.get('If-None-Match') == etag:
+            self.not_modified += 1
+            return 304, {'ETag': etag}, b''
+        selected = select(device, since)
+        if since is not None and not any(selected.values()):
+            self.not_modified += 1
+            return 304, {'ETag': etag}, b''
+
+        def body(entry):
+            added, s = entry
+            message = getBody(s.select(keys) if keys else s)
+            message['added'] = added
+            return message
+
+        data = {d: body(e) if single else [body(x) for x in e] for d, e in selected.items()}
+        if query.get('format', ['json'])[0] == 'cbor':
+            return 200, {'Content-Type': 'application/cbor', 'ETag': etag}, encodeCbor(data)
+        return 200, {'Content-Type': 'application/json', 'ETag': etag}, json.dumps(data).encode()
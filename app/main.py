@@ -3,50 +3,105 @@
 
 # project modules
 from datalogger import dataLogger
+from publisher import createPublisher
+from fleet import inverterFleet, getInverterUnits
+from metrics import httpServer
+from history import sampleHistory
+from clock import deadlineClock
 import sys, os, time
+import signal as signals
+import asyncio
 import logging
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
 import threading
 import configparser, argparse
-import paho.mqtt.client as paho
-import json
 
 # Global variable
 signal = None
 lock = threading.Lock()
+clocks = {}  # loop name -> deadlineClock, for the heartbeat
+pipeline = None  # the publish and storage stage of the logger thread or the fleet, if enabled
+history = None  # latest and recent samples of every inverter, served over http if enabled
+loggers = []  # the data loggers of the logger thread or the fleet, their buffers are written on shutdown
 
 
 # main threads
-def thread_logger(config):
-    global signal
+def thread_logger(config, publisher):
+    global signal, pipeline
     # create instance of datalogger
-    logger = dataLogger(config=config)
+    logger = dataLogger(config=config, publisher=publisher, history=history)
+    loggers.append(logger)
+    slog = logging.getLogger("__main__")
+    clock = clocks['logger'] = deadlineClock('logger', align=config['LOGGER'].get('AlignToClock', 'True') == 'True')
+    pipeline = logger.pipeline
     while True:
-        _signal = logger.logData()
+        # a failing cycle must not end the logger thread
+        try:
+            _signal = logger.logData()
+            with lock:
+                signal = _signal.value
+        except Exception:
+            slog.exception('logging cycle failed')
+        clock.wait(logger.waiting_time)
+
+
+# polls all configured inverters from one asyncio event loop
+def thread_fleet(config, publisher):
+    global pipeline
+
+    def on_cycle(fleet):
+        global signal
         with lock:
-            signal = _signal.value
-        time.sleep(logger.waiting_time)
+            signal = fleet.getStates()
+
+    fleet = inverterFleet(config=config, publisher=publisher, history=history)
+    loggers.extend(inverter.logger for inverter in fleet.inverters.values())
+    pipeline = fleet.pipeline
+    clocks.update({clock.name: clock for clock in fleet.clocks.values()})
+    asyncio.run(fleet.run(on_cycle=on_cycle))
 
 
 # a watch dog thread to see if still alive
-def thread_heartbeat(config):
+def thread_heartbeat(config, publisher):
     heart_beat_seconds = int(config['GENERAL']['HeartBeatSeconds'])
-    client = paho.Client("solarmax1")  # create client object
     slog = logging.getLogger("__main__")
     slog.debug('start heartbeat with interval=%d seconds' % heart_beat_seconds)
     start = datetime.now()
     _topic_base = f"{config['MQTT']['TopicPrefix']}-system"
     _msg = {'last_start': datetime.timestamp(start) * 1000, 'period': heart_beat_seconds,}
     i = 0
+    clock = clocks['heartbeat'] = deadlineClock('heartbeat')
 
     while True:
         i = i + 1
-        client.connect(host=config['MQTT']['BrokerHostUri'], port=int(conf['MQTT']['Port']))  # establish mqtt connection
         _msg['current_state'] = signal
         _msg['timestamp'] = datetime.timestamp(datetime.now())*1000
-        client.publish(f"{_topic_base}/heartbeat", json.dumps(_msg))  # publish mqtt
-        time.sleep(heart_beat_seconds)
+        _msg['mqtt'] = publisher.getStats()
+        _msg['clock'] = {name: c.getStats() for name, c in list(clocks.items())}
+        if pipeline is not None:
+            _msg['pipeline'] = pipeline.getStats()
+        if history is not None:
+            _msg['history'] = history.getStats()
+        publisher.publish(f"{_topic_base}/heartbeat", _msg)  # publish mqtt over the shared connection
+        clock.wait(heart_beat_seconds)
+
+
+# docker stop sends SIGTERM, which ends the process without running atexit while the logger threads are alive.
+# write the pipeline's queue, the time series store, the rollups and the frame capture first
+def shutdown(signum, frame):
+    slog = logging.getLogger("__main__")
+    slog.info(f"received signal {signum}, write buffers and exit")
+    try:
+        if pipeline is not None:
+            pipeline.stop()
+        for logger in list(loggers):
+            logger.close()
+        mqtt_publisher.stop()
+    except Exception:
+        slog.exception('shutdown failed')
+    logging.shutdown()
+    os._exit(0)
 
 
 if __name__ == '__main__':
@@ -95,13 +150,34 @@ if __name__ == '__main__':
 
     sl = logging.getLogger(__name__)
 
-    # initialize and start logger thread
-    t_log = threading.Thread(target=thread_logger, args=(conf,))
+    # one mqtt connection shared by all threads
+    mqtt_publisher = createPublisher(conf)
+    mqtt_publisher.start()
+
+    # prometheus metrics and the latest and recent samples on a small http server
+    http_server = None
+    if conf.has_section('HTTP') and conf['HTTP'].get('Enable', 'False') == 'True':
+        http_server = httpServer(port=int(conf['HTTP'].get('Port', '8088')), host=conf['HTTP'].get('Bind', '0.0.0.0'))
+        if int(conf['HTTP'].get('HistorySize', '360')) > 0:
+            history = sampleHistory.fromConfig(conf)
+            history.register(http_server)
+        http_server.start()
+
+    # initialize and start logger thread, several inverters or units are polled concurrently by the fleet engine
+    if len(getInverterUnits(conf)) > 1 or conf['LOGGER'].get('Engine', 'thread') == 'asyncio':
+        t_log = threading.Thread(target=thread_fleet, args=(conf, mqtt_publisher))
+    else:
+        t_log = threading.Thread(target=thread_logger, args=(conf, mqtt_publisher))
     sl.info(f"start logger thread")
     t_log.start()
 
     # initialize and start heartbeat thread
-    t_hb = threading.Thread(target=thread_heartbeat, args=(conf,))
+    t_hb = threading.Thread(target=thread_heartbeat, args=(conf, mqtt_publisher))
     sl.info(f"start heartbeat thread")
     t_hb.start()
 
+    # the main thread waits for signals, the handlers only run here
+    signals.signal(signals.SIGTERM, shutdown)
+    signals.signal(signals.SIGINT, shutdown)
+    t_log.join()
+
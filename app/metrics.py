@@ -0,0 +1,240 @@
+# This module collects runtime metrics and serves them in the prometheus text format.
+# updates are a few dict and list operations, so the instrumentation can stay on in production
+import time
+import bisect
+import threading
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class _metric:
+    TYPE = ''
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self.labels()  # metrics without labels show up as zero before the first update
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._newChild())
+        return child
+
+    def _newChild(self):
+        raise NotImplementedError
+
+    def _labelText(self, key, extra=''):
+        pairs = [f'{n}="{v}"' for n, v in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.TYPE}"]
+        for key, child in sorted(self._children.items()):
+            lines.extend(self._renderChild(key, child))
+        return lines
+
+
+class _value:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    # the value is read from function when rendered, for state kept elsewhere
+    def setFunction(self, function):
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class counter(_metric):
+    TYPE = 'counter'
+
+    def _newChild(self):
+        return _value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _renderChild(self, key, child):
+        return [f"{self.name}{self._labelText(key)} {child.get()}"]
+
+
+class gauge(counter):
+    TYPE = 'gauge'
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _buckets:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # times the with block
+    def time(self):
+        return _timer(self)
+
+
+class _timer:
+    __slots__ = ('_buckets', '_start')
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._buckets.observe(time.perf_counter() - self._start)
+        return False
+
+
+class histogram(_metric):
+    TYPE = 'histogram'
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(buckets)
+        super().__init__(name, description, labelnames)
+
+    def _newChild(self):
+        return _buckets(self.bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _renderChild(self, key, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), child.counts):
+            cumulative += count
+            le = 'le="%s"' % ('+Inf' if bound == float('inf') else repr(bound))
+            lines.append(f"{self.name}_bucket{self._labelText(key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labelText(key)} {child.sum}")
+        lines.append(f"{self.name}_count{self._labelText(key)} {child.count}")
+        return lines
+
+
+class metricsRegistry:
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description, labelnames=()):
+        return self._add(counter(name, description, labelnames))
+
+    def gauge(self, name, description, labelnames=()):
+        return self._add(gauge(name, description, labelnames))
+
+    def histogram(self, name, description, labelnames=(), buckets=histogram.DEFAULT_BUCKETS):
+        return self._add(histogram(name, description, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = metricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram('solarmax_stage_seconds', 'duration of the stages of a logging cycle', ['stage'])
+CONNECT_SECONDS = STAGE_SECONDS.labels('connect')
+SEND_SECONDS = STAGE_SECONDS.labels('send')
+RECEIVE_SECONDS = STAGE_SECONDS.labels('receive')
+DECODE_SECONDS = STAGE_SECONDS.labels('decode')
+PUBLISH_SECONDS = STAGE_SECONDS.labels('publish')
+CYCLE_SECONDS = STAGE_SECONDS.labels('cycle')
+
+CHECKSUM_FAILURES = REGISTRY.counter('solarmax_checksum_failures_total', 'responses with a bad checksum')
+UNSUPPORTED_PARAMS = REGISTRY.counter('solarmax_unsupported_params_total',
+                                      'requested parameters missing in the answer')
+CONNECT_FAILURES = REGISTRY.counter('solarmax_connect_failures_total', 'failed connects to an inverter')
+WAITING_SECONDS = REGISTRY.gauge('solarmax_waiting_seconds', 'current waiting time between queries', ['device'])
+LOGGER_STATE = REGISTRY.gauge('solarmax_logger_state', 'current logger state', ['device'])
+STATE_TRANSITIONS = REGISTRY.counter('solarmax_logger_state_transitions_total', 'logger state changes',
+                                     ['device', 'from', 'to'])
+MQTT_PUBLISH_LATENCY = REGISTRY.histogram('solarmax_mqtt_publish_latency_seconds',
+                                          'time from handing a message to paho until it is written')
+MQTT_MESSAGES = REGISTRY.gauge('solarmax_mqtt_messages', 'mqtt messages by state', ['state'])
+
+
+# serves the registry on /metrics, further routes can be added as path -> function(handler) returning
+# (status, headers, body)
+class httpServer:
+
+    def __init__(self, port=8088, host='0.0.0.0', registry=REGISTRY, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.routes = {'/metrics': self._metrics}
+        self._server = None
+
+    def _metrics(self, request):
+        return 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}, self.registry.render().encode()
+
+    def addRoute(self, path, function):
+        self.routes[path] = function
+
+    def start(self):
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                route = server.routes.get(self.path.split('?')[0])
+                if route is None:
+                    status, headers, body = 404, {'Content-Type': 'text/plain'}, b'not found\n'
+                else:
+                    status, headers, body = route(self)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server.log.debug('http %s - %s' % (self.address_string(), format % args))
+
+        self._server = ThreadingHTTPServer((self.host, self.port), handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.log.info(f"http server listening on {self.host}:{self.port}")
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,147 @@
+# This module builds the compact per-cycle payload: one message per cycle with the time and all values,
+# encoded as CBOR (RFC 8949, pure python encoder below) or as MessagePack if the msgpack package is installed.
+#   {'t': <epoch seconds of SDAT>, 'mod': <0 or 1>, 'v': {<key>: <value>, ...}}
+# descriptions and units go out once as a retained json schema message instead of with every sample
+import re
+import struct
+import logging
+from datetime import datetime
+from solarmax import sm13MT2, sample
+
+try:
+    import msgpack
+except ImportError:  # optional, only needed for Format = msgpack
+    msgpack = None
+
+_UNIT = re.compile(r'\(([^)]*)\)\s*$')
+FLOAT32_MAX = 3.4028234663852886e38  # larger floats overflow struct.pack('>f'), they go as f64
+
+
+def _head(major, n):
+    if n < 24:
+        return bytes([major << 5 | n])
+    if n < 0x100:
+        return bytes([major << 5 | 24, n])
+    if n < 0x10000:
+        return bytes([major << 5 | 25]) + struct.pack('>H', n)
+    if n < 0x100000000:
+        return bytes([major << 5 | 26]) + struct.pack('>I', n)
+    return bytes([major << 5 | 27]) + struct.pack('>Q', n)
+
+
+def _encodeCbor(obj, out):
+    if obj is None or isinstance(obj, bool):
+        out.append(0xF6 if obj is None else 0xF5 if obj else 0xF4)
+    elif isinstance(obj, int):
+        out += _head(0, obj) if obj >= 0 else _head(1, -1 - obj)
+    elif isinstance(obj, float):
+        if obj.is_integer() and abs(obj) < 2 ** 63:
+            _encodeCbor(int(obj), out)  # scaled inverter values are mostly whole numbers
+        elif abs(obj) <= FLOAT32_MAX and struct.unpack('>f', struct.pack('>f', obj))[0] == obj:
+            out += b'\xfa' + struct.pack('>f', obj)
+        else:
+            out += b'\xfb' + struct.pack('>d', obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf8')
+        out += _head(3, len(data)) + data
+    elif isinstance(obj, (bytes, bytearray)):
+        out += _head(2, len(obj)) + obj
+    elif isinstance(obj, (list, tuple)):
+        out += _head(4, len(obj))
+        for item in obj:
+            _encodeCbor(item, out)
+    elif isinstance(obj, dict):
+        out += _head(5, len(obj))
+        for key, value in obj.items():
+            _encodeCbor(key, out)
+            _encodeCbor(value, out)
+    elif isinstance(obj, datetime):
+        _encodeCbor(int(obj.timestamp()), out)
+    else:
+        raise TypeError(f"cannot encode {type(obj).__name__} as cbor")
+
+
+def encodeCbor(obj):
+    out = bytearray()
+    _encodeCbor(obj, out)
+    return bytes(out)
+
+
+# decoder for the subset written above, for consumers and the replay tool
+def decodeCbor(data):
+    value, _ = _decodeCbor(memoryview(data), 0)
+    return value
+
+
+def _decodeCbor(data, i):
+    major, info = data[i] >> 5, data[i] & 0x1F
+    i += 1
+    if major == 7:
+        if info == 26:
+            return struct.unpack('>f', data[i:i + 4])[0], i + 4
+        if info == 27:
+            return struct.unpack('>d', data[i:i + 8])[0], i + 8
+        return {20: False, 21: True, 22: None}[info], i
+    if info < 24:
+        n = info
+    else:
+        size = 1 << (info - 24)
+        n = int.from_bytes(data[i:i + size], 'big')
+        i += size
+    if major == 0:
+        return n, i
+    if major == 1:
+        return -1 - n, i
+    if major == 2:
+        return bytes(data[i:i + n]), i + n
+    if major == 3:
+        return str(data[i:i + n], 'utf8'), i + n
+    if major == 4:
+        items = []
+        for _ in range(n):
+            item, i = _decodeCbor(data, i)
+            items.append(item)
+        return items, i
+    if major == 5:
+        items = {}
+        for _ in range(n):
+            key, i = _decodeCbor(data, i)
+            items[key], i = _decodeCbor(data, i)
+        return items, i
+    raise ValueError(f"unsupported cbor major type {major}")
+
+
+# the body of a compact message, datetimes as epoch seconds, also served by the http history endpoints
+def getBody(message: sample):
+    values = {key: int(value.timestamp()) if isinstance(value, datetime) else value for key, value in message.items()}
+    return {'t': int(message.ts) if message.ts else None, 'mod': message.mod, 'v': values}
+
+
+class cyclePayload:
+    FORMATS = ('cbor', 'msgpack')
+
+    def __init__(self, fmt='cbor', logger='__main__'):
+        self.log = logging.getLogger(logger)
+        if fmt == 'msgpack' and msgpack is None:
+            self.log.warning('msgpack is not installed, using cbor for the cycle payload')
+            fmt = 'cbor'
+        if fmt not in self.FORMATS:
+            raise ValueError(f"unknown payload format {fmt}")
+        self.format = fmt
+
+    def encode(self, message: sample):
+        body = getBody(message)
+        if self.format == 'msgpack':
+            return msgpack.packb(body)
+        return encodeCbor(body)
+
+    # description and unit of every key, published retained once per connection
+    def getSchema(self, keys):
+        schema = {'format': self.format, 'time': 'epoch seconds', 'keys': {}}
+        for key in keys:
+            if key not in sm13MT2.QUERY_MAP:
+                continue
+            name = sm13MT2.QUERY_MAP[key]['name']
+            unit = _UNIT.search(name)
+            schema['keys'][key] = {'description': name, 'unit': unit.group(1) if unit else ''}
+        return schema
@@ -0,0 +1,145 @@
+# This module decouples polling from publishing and storage: the poll loop puts (function, item) pairs into a
+# bounded queue and a worker thread calls function(item), so a slow broker or sd card does not stretch the
+# sampling period. when the queue is full the backpressure policy decides:
+#   drop_oldest   the oldest queued item is dropped
+#   coalesce      the new item is merged into the newest queued one of the same function, see coalesce below
+#   block         the poll loop waits for room, not with the fleet, whose event loop must not block
+import time
+import threading
+import logging
+from collections import deque
+import metrics
+
+DEPTH = metrics.REGISTRY.gauge('solarmax_pipeline_depth', 'items waiting for the publish and storage stage')
+ITEMS = metrics.REGISTRY.counter('solarmax_pipeline_items_total', 'items by stage and outcome', ['stage', 'result'])
+
+
+class samplePipeline:
+    POLICIES = ('drop_oldest', 'coalesce', 'block')
+
+    # coalesce(old, new) returns the merged item, or None if the two cannot be merged and the oldest is dropped
+    def __init__(self, maxsize=100, policy='drop_oldest', coalesce=None, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown backpressure policy {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.coalesce = coalesce or (lambda old, new: new)
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+        # statistics
+        self.received = 0  # items put by the poll stage
+        self.queued = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked_seconds = 0.0
+        self._rate_time = time.monotonic()
+        self._rate_counts = (0, 0)
+
+        DEPTH.labels().setFunction(self.depth)
+        self._queued = ITEMS.labels('poll', 'queued')
+        self._processed = ITEMS.labels('publish', 'processed')
+        self._failed = ITEMS.labels('publish', 'failed')
+        self._dropped = ITEMS.labels('poll', 'dropped')
+        self._coalesced = ITEMS.labels('poll', 'coalesced')
+
+    def depth(self):
+        return len(self._queue)
+
+    # queue depth, totals and the throughput of both stages in items/s since the last call
+    def getStats(self):
+        now = time.monotonic()
+        elapsed = max(now - self._rate_time, 1e-6)
+        received, processed = self.received, self.processed
+        stats = {'depth': len(self._queue), 'maxsize': self.maxsize, 'policy': self.policy, 'received': received,
+                 'queued': self.queued, 'processed': processed, 'failed': self.failed, 'dropped': self.dropped,
+                 'coalesced': self.coalesced, 'blocked_seconds': round(self.blocked_seconds, 3),
+                 'poll_rate': round((received - self._rate_counts[0]) / elapsed, 2),
+                 'publish_rate': round((processed - self._rate_counts[1]) / elapsed, 2)}
+        self._rate_time, self._rate_counts = now, (received, processed)
+        return stats
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._work, name='pipeline', daemon=True)
+        self._thread.start()
+
+    # stops after the queued items are done, or after timeout seconds
+    def stop(self, timeout=10):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def put(self, function, item):
+        with self._cond:
+            self.received += 1
+            if len(self._queue) >= self.maxsize:
+                if self.policy == 'block':
+                    started = time.monotonic()
+                    while len(self._queue) >= self.maxsize and self._running:
+                        self._cond.wait()
+                    self.blocked_seconds += time.monotonic() - started
+                elif not self._coalesce(function, item):
+                    self._queue.popleft()
+                    self.dropped += 1
+                    self._dropped.inc()
+                else:
+                    return
+            self._queue.append((function, item))
+            self.queued += 1
+            self._queued.inc()
+            self._cond.notify_all()
+
+    # merges into the newest queued item of the same function, items of other functions (the other inverters
+    # of a fleet) may be queued behind it
+    def _coalesce(self, function, item):
+        if self.policy != 'coalesce':
+            return False
+        for i in range(len(self._queue) - 1, -1, -1):
+            if self._queue[i][0] == function:
+                break
+        else:
+            return False
+        merged = self.coalesce(self._queue[i][1], item)
+        if merged is None:
+            return False
+        self._queue[i] = (function, merged)
+        self.coalesced += 1
+        self._coalesced.inc()
+        return True
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue and self._running:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                function, item = self._queue.popleft()
+                self._cond.notify_all()  # room for a blocked producer
+            try:
+                function(item)
+                self.processed += 1
+                self._processed.inc()
+            except Exception:
+                self.failed += 1
+                self._failed.inc()
+                self.log.exception('publish and storage stage failed')
+
+
+# creates the pipeline from the [PIPELINE] section, None if it is disabled and the stages run inline
+def createPipeline(config, coalesce=None, logger='__main__'):
+    if not config.has_section('PIPELINE') or config['PIPELINE'].get('Enable', 'False') != 'True':
+        return None
+    pipeline = samplePipeline(maxsize=int(config['PIPELINE'].get('MaxQueued', '100')),
+                              policy=config['PIPELINE'].get('Policy', 'drop_oldest'), coalesce=coalesce,
+                              logger=logger)
+    pipeline.start()
+    return pipeline
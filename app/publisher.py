@@ -0,0 +1,212 @@
+# This module provides a long living mqtt publisher shared by the data logger and the heartbeat
+import json
+import os
+import socket
+import threading
+import time
+import logging
+import metrics
+from collections import deque
+import paho.mqtt.client as paho
+from solarmax import jsonDefault, sample
+from spool import batchSpool
+
+
+class mqttPublisher:
+
+    def __init__(self, broker, port, client_id=None, keepalive=60, max_queued=100, spool=None, replay_batch=50,
+                 logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.broker = broker
+        self.port = int(port)
+        self.keepalive = keepalive
+
+        # a fixed client id makes the broker kick the older of two connections, so make it unique per process
+        if not client_id:
+            client_id = f"solarmax-{socket.gethostname()}-{os.getpid()}"
+        self.client_id = client_id
+
+        self._lock = threading.Lock()
+        self._connected = False
+        self._queue = deque(maxlen=max_queued)  # batches waiting for a connection
+        self._retained = {}  # topic -> payload, published with retain on every connect
+        self.spool = spool  # optional disk spool, takes the data batches instead of the in-memory queue
+        self.replay_batch = replay_batch
+
+        # statistics
+        self.connects = 0
+        self.published = 0
+        self.acked = 0
+        self.dropped = 0
+        self._sent_at = {}  # mid -> perf counter at hand over, for the publish latency
+
+        metrics.MQTT_MESSAGES.labels('in_flight').setFunction(lambda: max(self.published - self.acked, 0))
+        metrics.MQTT_MESSAGES.labels('queued').setFunction(lambda: sum(len(b) for b in list(self._queue)))
+        metrics.MQTT_MESSAGES.labels('dropped').setFunction(lambda: self.dropped)
+        if self.spool is not None:
+            metrics.MQTT_MESSAGES.labels('spooled').setFunction(self.spool.depth)
+
+        self._client = paho.Client(client_id)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+        self._client.reconnect_delay_set(min_delay=1, max_delay=120)
+
+    def start(self):
+        # connect in the background, paho's network loop reconnects automatically
+        self.log.info(f"start mqtt publisher {self.client_id} for broker {self.broker}:{self.port}")
+        self._client.connect_async(self.broker, self.port, self.keepalive)
+        self._client.loop_start()
+
+    def stop(self):
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    def isConnected(self):
+        return self._connected
+
+    def getStats(self):
+        with self._lock:
+            stats = {'connected': self._connected, 'connects': self.connects, 'published': self.published,
+                     'acked': self.acked, 'in_flight': max(self.published - self.acked, 0),
+                     'queued': len(self._queue), 'dropped': self.dropped}
+        if self.spool is not None:
+            stats['spool'] = self.spool.getStats()
+        return stats
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            self.log.warning(f"mqtt connect to {self.broker}:{self.port} refused (rc={rc})")
+            return
+        self.log.info(f"mqtt connected to {self.broker}:{self.port}")
+        with self._lock:
+            self._connected = True
+            self.connects += 1
+            queued = list(self._queue)
+            self._queue.clear()
+        self._publishRetained()
+        for batch in queued:
+            self._send(batch)
+
+    def _on_disconnect(self, client, userdata, rc):
+        with self._lock:
+            self._connected = False
+        if rc != 0:
+            self.log.warning(f"mqtt connection to {self.broker}:{self.port} lost (rc={rc}), reconnecting")
+
+    def _on_publish(self, client, userdata, mid):
+        with self._lock:
+            self.acked += 1
+            sent = self._sent_at.pop(mid, None)
+        if sent is not None:
+            metrics.MQTT_PUBLISH_LATENCY.observe(time.perf_counter() - sent)
+
+    # paho calls on_publish from its network thread, so do not hold the lock while handing messages over.
+    # returns the messages paho did not accept
+    def _send(self, batch):
+        failed = []
+        sent = []
+        with metrics.PUBLISH_SECONDS.time():
+            for topic, payload in batch:
+                t0 = time.perf_counter()
+                info = self._client.publish(topic, payload)
+                if info.rc == paho.MQTT_ERR_SUCCESS:
+                    sent.append((info.mid, t0))
+                else:
+                    failed.append((topic, payload))
+        with self._lock:
+            self.published += len(batch) - len(failed)
+            if len(self._sent_at) > 10000:  # acks that never came, e.g. after a reconnect
+                self._sent_at.clear()
+            for mid, t0 in sent:
+                # a fast ack may have been counted before we got here, its latency is lost then
+                self._sent_at.setdefault(mid, t0)
+        return failed
+
+    # returns False if the batch was not held because the connection came up meanwhile, _on_connect flushes the
+    # queue under the same lock, so a batch queued after the flush would wait for the next reconnect
+    def _hold(self, batch, spool, unless_connected=False):
+        if spool and self.spool is not None:
+            if not self.spool.append(batch):
+                with self._lock:
+                    self.dropped += len(batch)
+            return True
+        with self._lock:
+            if unless_connected and self._connected:
+                return False
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += len(self._queue[0])
+            self._queue.append(batch)
+        return True
+
+    # returns the messages of a spooled batch which were not handed over
+    def _replaySend(self, batch):
+        if not self._connected:
+            return batch
+        return self._send(batch)
+
+    # spooled batches are replayed oldest first before new data goes out
+    def _replay(self):
+        if self.spool is not None and self.spool.depth() > 0:
+            n = self.spool.replay(self._replaySend, self.replay_batch)
+            if n:
+                self.log.info(f"replayed {n} spooled batches, {self.spool.depth()} left")
+
+    def _submit(self, batch, spool=True):
+        if not self._connected and self._hold(batch, spool, unless_connected=True):
+            return False
+
+        self._replay()
+        failed = self._send(batch)
+        if failed:
+            self._hold(failed, spool)
+        return not failed
+
+    # publish all datapoints of a cycle at once, each key goes to its own topic <topic>/<key>. the sample is
+    # turned into the {'value': .., 'description': ..} json documents only here
+    def publishBatch(self, topic: str, message: sample):
+        batch = [(f"{topic}/{key}", json.dumps(datapoint, default=jsonDefault))
+                 for key, datapoint in message.toMessage().items()]
+        self.log.debug(f"publish {len(batch)} datapoints to {topic} via {self.broker}:{self.port}")
+        return self._submit(batch)
+
+    def _publishRetained(self):
+        with self._lock:
+            retained = list(self._retained.items())
+        for topic, payload in retained:
+            self._publishRetainedOne(topic, payload)
+
+    def _publishRetainedOne(self, topic, payload):
+        if self._client.publish(topic, payload, retain=True).rc == paho.MQTT_ERR_SUCCESS:
+            with self._lock:
+                self.published += 1
+
+    # a retained message, e.g. the schema of the cycle payload. it is sent again after every reconnect, so
+    # a broker that lost its retained store gets it back
+    def setRetained(self, topic: str, message: dict):
+        payload = json.dumps(message, default=jsonDefault)
+        with self._lock:
+            if self._retained.get(topic) == payload:
+                return
+            self._retained[topic] = payload
+        if self._connected:
+            self._publishRetainedOne(topic, payload)
+
+    # an already encoded message, e.g. the compact cycle payload
+    def publishPayload(self, topic: str, payload: bytes):
+        return self._submit([(topic, payload)])
+
+    # single messages like the heartbeat are not worth spooling, rollups are
+    def publish(self, topic: str, message: dict, spool=False):
+        return self._submit([(topic, json.dumps(message, default=jsonDefault))], spool=spool)
+
+
+# creates the publisher from the [MQTT] section, with a disk spool if [SPOOL] is enabled
+def createPublisher(config, logger='__main__'):
+    spool = None
+    if config.has_section('SPOOL') and config['SPOOL'].get('Enable', 'False') == 'True':
+        spool = batchSpool.fromConfig(config, logger=logger)
+    replay_batch = int(config['SPOOL'].get('ReplayBatch', '50')) if spool is not None else 50
+    return mqttPublisher(broker=config['MQTT']['BrokerHostUri'], port=config['MQTT']['Port'],
+                         client_id=config['MQTT'].get('ClientId'), spool=spool, replay_batch=replay_batch,
+                         logger=logger)
@@ -0,0 +1,140 @@
+# Replays captured frames (see app/capture.py) through the decoder and the storage and publish path of the
+# data logger, as fast as they can be decoded. used to backfill the time series store and the rollups, or to
+# reprocess history after a fix of QUERY_MAP:
+#   python3 app/replay.py --config ./data/solarmax.cfg --store --rollup data/capture/default.cap*
+#   python3 app/replay.py --config ./data/solarmax.cfg --device roof --publish
+# the rollups skip samples older than their saved state, point [ROLLUP] Path elsewhere to rebuild them
+import sys
+import time
+import logging
+import argparse
+import configparser
+from capture import RESPONSE, readCapture, getCaptureFiles
+from datalogger import dataLogger
+from solarmax import sample
+
+
+class frameReplay:
+
+    def __init__(self, logger, store=True, rollup=True, publish=False, max_in_flight=1000):
+        self.logger = logger
+        self.con = logger.session.con  # decoder of the configured device type, never connected
+        self.store = logger.store if store else None
+        self.rollup = logger.rollup if rollup else None
+        self.publish = publish and logger.mqtt_enable
+        self.topic = logger.getTopic(self.con.getDeviceType())
+        self.max_in_flight = max_in_flight  # messages handed to paho but not yet sent, replay waits above
+
+        # statistics
+        self.frames = 0
+        self.bad_frames = 0
+        self.samples = 0
+
+    # the responses of one cycle are merged into a sample, a key seen twice starts the next one
+    def _samples(self, files):
+        device = self.logger.device_name or 'default'
+        values = {}
+        for filename in files:
+            for ts, direction, frame in readCapture(filename):
+                if direction != RESPONSE:
+                    continue
+                self.frames += 1
+                response = frame.decode('utf8', 'replace')
+                if not self.con._validateChecksum(response):
+                    self.bad_frames += 1
+                    continue
+                decoded = self.con._decode(response)
+                if not decoded:
+                    self.bad_frames += 1
+                    continue
+                if not values.keys().isdisjoint(decoded):
+                    yield sample.fromValues(values, device)
+                    values = {}
+                values.update(decoded)
+        if values:
+            yield sample.fromValues(values, device)
+
+    def inFlight(self):
+        publisher = self.logger.publisher
+        return publisher.published - publisher.acked
+
+    # the publisher connects in the background, batches submitted before would queue up and be dropped
+    def waitConnected(self, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while not self.logger.publisher.isConnected():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    # waits until every message went out, returns False after timeout seconds
+    def drain(self, timeout=60.0):
+        deadline = time.monotonic() + timeout
+        while self.inFlight() > 0 or self.logger.publisher.getStats()['queued'] > 0:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def run(self, files):
+        for current in self._samples(files):
+            if self.store is not None:
+                self.store.append(current)
+            closed = self.rollup.add(current) if self.rollup is not None else []
+            if self.publish:
+                while self.inFlight() > self.max_in_flight:
+                    time.sleep(0.001)  # the samples come faster than any broker takes them
+                self.logger._sendToMQTT(topic=self.topic, message=current)
+                self.logger._sendRollups(self.topic, closed)
+            self.samples += 1
+        if self.store is not None:
+            self.store.flush()
+        if self.rollup is not None:
+            self.rollup.save()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replay captured inverter frames')
+    parser.add_argument('files', nargs='*', help='capture files, default: all of the device, oldest first')
+    parser.add_argument('--config', default='./data/solarmax.cfg', help='path of the config file')
+    parser.add_argument('--device', default='', help='inverter name, the suffix of [INVERTER:<name>]')
+    parser.add_argument('--store', action='store_true', help='append the samples to the time series store')
+    parser.add_argument('--rollup', action='store_true', help='feed the samples to the rollups')
+    parser.add_argument('--publish', action='store_true', help='publish samples and rollups over mqtt')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout,
+                        format='%(asctime)s %(levelname)s %(module)s/%(funcName)s: %(message)s')
+    config = configparser.ConfigParser()
+    if config.read(args.config) == []:
+        sys.exit('Error: Missing Config File ' + args.config)
+    # replay writes wherever the logger would, but must not capture its own input again
+    capture_path = config['CAPTURE'].get('Path', './data/capture') if config.has_section('CAPTURE') \
+        else './data/capture'
+    config['CAPTURE'] = {'Enable': 'False'}
+    for section, flag in (('STORE', args.store), ('ROLLUP', args.rollup)):
+        if flag:
+            if not config.has_section(section):
+                config.add_section(section)
+            config[section]['Enable'] = 'True'
+    config['MQTT']['Enable'] = str(args.publish)
+
+    logger = dataLogger(config=config, inverter=f"INVERTER:{args.device}" if args.device else 'INVERTER')
+    files = args.files or getCaptureFiles(capture_path, args.device or 'default')
+    replay = frameReplay(logger, store=args.store, rollup=args.rollup, publish=args.publish)
+
+    if replay.publish and not replay.waitConnected():
+        sys.exit(f"Error: broker {logger.mqtt_broker}:{logger.mqtt_port} not reachable")
+
+    started = time.perf_counter()
+    replay.run(files)
+    summary = f"replayed {replay.samples} samples from {replay.frames} frames ({replay.bad_frames} bad) of " \
+              f"{len(files)} files"
+    if replay.publish:
+        if not replay.drain():
+            logging.warning(f"publisher not drained, {replay.inFlight()} messages still in flight")
+        summary += f", {logger.publisher.getStats()['dropped']} messages dropped"
+    elapsed = time.perf_counter() - started
+    logging.info(f"{summary} in {elapsed:.1f} s, {replay.samples / max(elapsed, 1e-6):.0f} samples/s")
+    if logger.publisher is not None:
+        logger.publisher.stop()
@@ -0,0 +1,193 @@
+# This module aggregates the momentary channels into fixed windows (per minute, per 15 minutes, per day by
+# default) while the samples stream in, so consumers can subscribe to the low rate rollup topics instead of
+# every raw sample. each window keeps running min, max, sum and count per key and the energy of the power
+# channels by trapezoidal integration. the state is saved when a window closes, so a restart neither loses
+# the open windows nor counts a sample twice
+import os
+import json
+import logging
+from datetime import datetime
+from solarmax import sm13MT2, sample
+
+
+class _stats:
+    __slots__ = ('min', 'max', 'sum', 'count')
+
+    def __init__(self, value):
+        self.min = self.max = self.sum = value
+        self.count = 1
+
+    def add(self, value):
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+
+
+# area in Ws under the line (t0, p0) - (t1, p1) between a and b
+def _integrate(t0, p0, t1, p1, a, b):
+    a, b = max(a, t0), min(b, t1)
+    if b <= a:
+        return 0.0
+    slope = (p1 - p0) / (t1 - t0)
+    return (p0 + slope * ((a + b) / 2 - t0)) * (b - a)
+
+
+class _window:
+    __slots__ = ('period', 'start', 'end', 'stats', 'energy')
+
+    def __init__(self, period, ts):
+        self.period = period
+        if period == 86400:
+            # days follow the local calendar
+            self.start = int(datetime.fromtimestamp(ts).replace(hour=0, minute=0, second=0).timestamp())
+            self.end = int(datetime.fromtimestamp(self.start + 90000).replace(hour=0, minute=0, second=0)
+                           .timestamp())
+        else:
+            self.start = ts - ts % period
+            self.end = self.start + period
+        self.stats = {}
+        self.energy = {}
+
+    def add(self, values):
+        for key, value in values.items():
+            stats = self.stats.get(key)
+            if stats is None:
+                self.stats[key] = _stats(value)
+            else:
+                stats.add(value)
+
+    def toMessage(self):
+        message = {'start': datetime.fromtimestamp(self.start), 'end': datetime.fromtimestamp(self.end)}
+        for key, s in sorted(self.stats.items()):
+            message[key] = {'min': round(s.min, 3), 'max': round(s.max, 3), 'mean': round(s.sum / s.count, 3),
+                            'count': s.count, 'description': sm13MT2.QUERY_MAP[key]['name']}
+        for key, ws in sorted(self.energy.items()):
+            message[f"E{key}"] = {'value': round(ws / 3600, 3), 'description': f"energy from {key} (Wh)"}
+        return message
+
+    def toState(self):
+        return {'period': self.period, 'start': self.start, 'end': self.end, 'energy': self.energy,
+                'stats': {key: [s.min, s.max, s.sum, s.count] for key, s in self.stats.items()}}
+
+    @classmethod
+    def fromState(cls, state):
+        window = cls.__new__(cls)
+        window.period, window.start, window.end = state['period'], state['start'], state['end']
+        window.energy = state['energy']
+        window.stats = {}
+        for key, (lo, hi, total, count) in state['stats'].items():
+            s = window.stats[key] = _stats(lo)
+            s.max, s.sum, s.count = hi, total, count
+        return window
+
+
+class rollupAggregator:
+    NAMES = {60: '1m', 900: '15m', 3600: '1h', 86400: '1d'}
+
+    def __init__(self, periods=(60, 900, 86400), keys=None, energy_keys=('PAC', 'PDC'), max_gap=300,
+                 path=None, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.periods = tuple(periods)
+        self.keys = set(keys) if keys is not None else set(sm13MT2.MOMENTARIES)
+        self.energy_keys = tuple(energy_keys)
+        self.max_gap = max_gap  # seconds, longer gaps between samples are not integrated
+        self.path = path  # state file, None keeps the state in memory only
+
+        self._windows = {}  # period -> open window
+        self._last_ts = 0  # samples at or before this time were already counted
+        self._last_power = None  # key -> power of the last sample, None after a forced zero sample
+        self._load()
+
+    @classmethod
+    def fromConfig(cls, config, device='default', logger='__main__'):
+        section = config['ROLLUP']
+        path = section.get('Path', './data/rollup')
+        return cls(periods=[int(p) for p in section.get('Windows', '60,900,86400').split(',')],
+                   energy_keys=[k.strip() for k in section.get('EnergyKeys', 'PAC,PDC').split(',') if k.strip()],
+                   max_gap=int(section.get('MaxGap', '300')),
+                   path=os.path.join(path, f"{device}.json") if path else None, logger=logger)
+
+    def getName(self, period):
+        return self.NAMES.get(period, f"{period}s")
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            self._last_ts = state['last_ts']
+            self._last_power = state['last_power']
+            self._windows = {w['period']: _window.fromState(w) for w in state['windows']
+                             if w['period'] in self.periods}
+            self.log.info(f"rollup state restored, last sample at {datetime.fromtimestamp(self._last_ts)}")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.log.warning(f"rollup state {self.path} not readable, starting empty: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        state = {'last_ts': self._last_ts, 'last_power': self._last_power,
+                 'windows': [w.toState() for w in self._windows.values()]}
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)  # atomic, a crash leaves the old or the new state
+
+    # adds a decoded sample and returns the windows it closed as (name, message)
+    def add(self, sample: sample):
+        ts = int(sample.ts)
+        if ts <= self._last_ts:
+            return []  # no SDAT, repeated SDAT or already counted before a restart
+
+        values = {key: value for key, value in sample.items()
+                  if key in self.keys and isinstance(value, (int, float))}
+        power = {key: values[key] for key in self.energy_keys if key in values}
+        segment = None
+        if self._last_power is not None and ts - self._last_ts <= self.max_gap:
+            segment = (self._last_ts, ts)
+
+        closed = []
+        for period in self.periods:
+            window = self._windows.get(period)
+            if window is None or ts >= window.end:
+                new = self._windows[period] = _window(period, ts)
+                if window is not None:
+                    # the closing window takes the energy up to the start of the new one, gaps included
+                    self._addEnergy(window, segment, power, window.start, new.start)
+                    closed.append((self.getName(period), window.toMessage()))
+                window = new
+            self._addEnergy(window, segment, power, window.start, window.end)
+            window.add(values)
+
+        self._last_ts = ts
+        self._last_power = power
+        if closed:
+            self.save()
+        return closed
+
+    def _addEnergy(self, window, segment, power, a, b):
+        if segment is None:
+            return
+        t0, t1 = segment
+        for key, p1 in power.items():
+            p0 = self._last_power.get(key)
+            if p0 is not None:
+                window.energy[key] = window.energy.get(key, 0.0) + _integrate(t0, p0, t1, p1, a, b)
+
+    # the inverter went down: the zero-forced sample repeats the last SDAT and carries no measurement, so it
+    # only ends the integration and closes the short windows, which will not get further samples
+    def forceZero(self):
+        self._last_power = None
+        closed = []
+        for period in self.periods:
+            window = self._windows.get(period)
+            if window is not None and period < 86400:
+                closed.append((self.getName(period), window.toMessage()))
+                del self._windows[period]
+        self.save()
+        return closed
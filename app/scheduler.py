@@ -0,0 +1,54 @@
+# This module decides which parameters are due on a logging cycle, so each parameter class is polled at its own rate
+import math
+import time
+import logging
+from solarmax import sm13MT2
+
+
+class pollScheduler:
+    # intervals per parameter class, see sm13MT2.getParameterClass
+    DEFAULT_INTERVALS = {'momentary': 10, 'slow': 60, 'static': 3600}
+
+    # SDAT is the timestamp of the sample and goes into every query
+    ALWAYS = {'SDAT'}
+
+    def __init__(self, commands, class_intervals=None, key_intervals=None, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        intervals = dict(self.DEFAULT_INTERVALS)
+        intervals.update(class_intervals or {})
+        key_intervals = key_intervals or {}
+
+        self.commands = list(commands)
+        self.intervals = {key: int(key_intervals.get(key, intervals[sm13MT2.getParameterClass(key)]))
+                          for key in self.commands}
+
+        # the logger ticks at the greatest common divisor of all intervals
+        self.tick = 0
+        for interval in self.intervals.values():
+            self.tick = math.gcd(self.tick, interval)
+        self.tick = max(self.tick, 1)
+
+        self._next_due = {key: 0.0 for key in self.commands}
+        self.log.info(f"poll scheduler tick is {self.tick} seconds, intervals: {self.intervals}")
+
+    @classmethod
+    def fromConfig(cls, config, commands, logger='__main__'):
+        section = config['SCHEDULE']
+        class_intervals = {name: int(section[name.capitalize()]) for name in cls.DEFAULT_INTERVALS
+                           if name.capitalize() in section}
+        key_intervals = {key: int(section[key]) for key in commands if key in section}
+        return cls(commands, class_intervals, key_intervals, logger)
+
+    # keys due at now, in command order. half a tick of slack keeps a late tick from skipping a whole interval
+    def getDue(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        limit = now + self.tick / 2
+        return [key for key in self.commands if self._next_due[key] <= limit or key in self.ALWAYS]
+
+    def markPolled(self, keys, now=None):
+        if now is None:
+            now = time.monotonic()
+        for key in keys:
+            if key in self._next_due:
+                self._next_due[key] = now + self.intervals[key]
@@ -0,0 +1,172 @@
+# This module keeps a long living connection to the inverter across logging cycles
+import select
+import socket
+import time
+import logging
+from solarmax import communication, sm13MT2
+from capability import IDENTITY, getModel, capabilityProbe
+
+
+# static parameters (type, software version, mac, ...) are fetched once per connection and merged into later
+# samples from here, the cache is invalidated on reconnect and after ttl seconds (0 disables the cache)
+class staticCache:
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._values = {}
+        self._keys = frozenset()  # static keys requested by the last full query, answered or not
+        self._time = 0.0
+        self.hits = 0
+
+    def invalidate(self):
+        self._values = {}
+        self._keys = frozenset()
+
+    def _isValid(self, static):
+        return self.ttl > 0 and static <= self._keys and time.monotonic() - self._time < self.ttl
+
+    # the commands which have to be sent to the inverter
+    def getCommands(self, commandlist):
+        static = sm13MT2.STATICS.intersection(commandlist)
+        if not static or not self._isValid(static):
+            return commandlist
+        commands = [key for key in commandlist if key not in static]
+        return commands if commands else commandlist
+
+    # remember the statics of a successful query, or merge the cached ones into it
+    def update(self, commandlist, decoded):
+        static = sm13MT2.STATICS.intersection(commandlist)
+        if static:
+            self._values = {key: decoded[key] for key in static if key in decoded}
+            self._keys = frozenset(static)
+            self._time = time.monotonic()
+        elif self._values:
+            self.hits += 1
+            decoded.update(self._values)
+
+
+class inverterSession:
+
+    def __init__(self, ip, port, adr=1, backoff_min=1, backoff_max=60, static_ttl=3600, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self._ip = ip
+        self._port = int(port)
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self._backoff = 0
+        self._next_attempt = 0.0
+
+        # one communication object for the whole session, so socket and query plans survive between cycles
+        self.con = communication(ip=ip, port=port, adr=adr, logger=logger, autoconnect=False)
+        self.statics = staticCache(ttl=static_ttl)
+        self.capabilities = None  # optional capability.capabilityCache, the device is identified on connect
+        self._identified = False
+
+        # statistics
+        self.connects = 0
+        self.reuses = 0
+        self.failed_connects = 0
+        self.dead_peers = 0
+
+    def getStats(self):
+        return {'connects': self.connects, 'reuses': self.reuses, 'failed_connects': self.failed_connects,
+                'dead_peers': self.dead_peers, 'backoff': self._backoff, 'static_hits': self.statics.hits}
+
+    # the inverter closes idle connections silently, check if the peer is still there before reusing the socket.
+    # a readable socket between two queries means either eof (peer closed) or stale data, both are not usable
+    def _isAlive(self):
+        sock = self.con._socket
+        if not self.con.isConnected():
+            return False
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            if not readable:
+                return True
+            if sock.recv(1, socket.MSG_PEEK) == b'':
+                self.log.debug('peer %s:%i closed the connection' % (self._ip, self._port))
+                return False
+            self.log.debug('stale data on connection %s:%i, drop it' % (self._ip, self._port))
+            return False
+        except (OSError, ValueError):
+            return False
+
+    def _connect(self):
+        now = time.monotonic()
+        if now < self._next_attempt:
+            self.log.debug('reconnect to %s:%i deferred for %.1f seconds' %
+                           (self._ip, self._port, self._next_attempt - now))
+            return False
+
+        if self.con.connect():
+            self.connects += 1
+            self.statics.invalidate()  # the device behind the address may have changed
+            self._identified = False
+            self._backoff = 0
+            self._next_attempt = 0.0
+            return True
+
+        # connection failed, retry lazily with exponential backoff
+        self.failed_connects += 1
+        self._backoff = min(max(self._backoff * 2, self.backoff_min), self.backoff_max)
+        self._next_attempt = now + self._backoff
+        return False
+
+    def ensureConnected(self):
+        if self._isAlive():
+            self.reuses += 1
+            return True
+        if self.con.isConnected():
+            self.dead_peers += 1
+            self.con.disconnect()
+        return self._connect()
+
+    def query(self, commandlist):
+        if not self.ensureConnected():
+            # keep the buffers consistent with a failed query
+            self.con._beginQuery()
+            return False
+
+        if self.capabilities is not None and not self._identified and not self._identify():
+            self.con.disconnect()
+            return False
+
+        commands = self.statics.getCommands(commandlist)
+        status = self.con.query(commands)
+        if status:
+            self.statics.update(commands, self.con.decodeddata)
+        else:
+            # the inverter may have gone down, start over with a fresh connection next time
+            self.con.disconnect()
+        return status
+
+    # looks up the capabilities of the connected model, or probes them on its first connect
+    def _identify(self):
+        if not self.con.query(list(IDENTITY)):
+            return False
+        model = getModel(self.con.decodeddata)
+        self._identified = True
+        if model is None:
+            return True
+        cached = self.capabilities.get(model)
+        if cached is None:
+            probe = capabilityProbe(maxcommands=self.capabilities.max_chunk)
+            while not probe.isDone():
+                chunk = probe.nextChunk()
+                self.con._beginQuery()
+                ok = self.con._subquery(self.con._encodeRequest(chunk), frozenset(chunk))
+                probe.feed(chunk, self.con.decodeddata if ok else None)
+                if not ok:
+                    # a late answer must not be taken for the one to the smaller chunk
+                    self.con.disconnect()
+                    if not self.con.connect():
+                        return False
+            self.capabilities.put(model, probe)
+            cached = self.capabilities.get(model)
+        self.con.setCapabilities(*cached)
+        return True
+
+    def getDeviceType(self):
+        return self.con.getDeviceType()
+
+    def close(self):
+        self.con.disconnect()
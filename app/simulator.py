@@ -0,0 +1,306 @@
+# This module simulates SolarMax inverters on local tcp ports for load, latency and soak tests.
+# every virtual inverter answers the keys of sm13MT2.QUERY_MAP with plausible diurnal values and can
+# inject latency, split or coalesced segments, bad checksums, dropped connections and night time offline periods
+#   python3 app/simulator.py --count 100 --base-port 20000 --latency 20 --split 0.1
+import sys
+import math
+import random
+import asyncio
+import argparse
+import threading
+import time
+import logging
+from datetime import datetime, timedelta
+from solarmax import sm13MT2, communication, frameReader
+
+
+class faultProfile:
+
+    def __init__(self, latency=0.0, jitter=0.0, split=0.0, coalesce=0.0, bad_checksum=0.0, drop=0.0,
+                 offline_at_night=False, max_answer=0):
+        self.latency = latency  # seconds before an answer
+        self.jitter = jitter  # random extra seconds, uniform
+        self.split = split  # probability to deliver an answer in several segments
+        self.coalesce = coalesce  # probability to deliver the previous answer again in front of the new one
+        self.bad_checksum = bad_checksum  # probability of a corrupted checksum
+        self.drop = drop  # probability to close the connection instead of answering
+        self.offline_at_night = offline_at_night  # refuse connections while there is no sun
+        self.max_answer = max_answer  # answers with more data bytes are not sent at all, 0 = no limit
+
+
+class virtualInverter:
+    DEFAULT_VALUES = {'LAN': 1, 'SWV': 224, 'BDN': 2004, 'SAL': 0, 'TYP': 20010}
+
+    def __init__(self, adr=1, pin=13000, sunrise=6.0, sunset=20.0, clock=None, seed=None):
+        self.adr = adr
+        self.pin = pin
+        self.sunrise = sunrise
+        self.sunset = sunset
+        self.clock = clock or datetime.now
+        self._random = random.Random(seed)
+        self._mac = '%08X' % self._random.getrandbits(32)
+        self._day = None
+        self._last = None
+        self.kdy = 0.0
+        self.kt0 = 20000.0 + self._random.random() * 10000
+        self.khr = 9000.0 + self._random.random() * 1000
+        self.cac = self._random.randint(500, 2000)
+        self.requests = 0
+
+    # relative power from the time of day, a sine between sunrise and sunset with some clouds
+    def _sun(self, now):
+        hour = now.hour + now.minute / 60 + now.second / 3600
+        if not self.sunrise < hour < self.sunset:
+            return 0.0
+        clouds = 0.75 + 0.25 * self._random.random()
+        return math.sin(math.pi * (hour - self.sunrise) / (self.sunset - self.sunrise)) * clouds
+
+    def isOnline(self, now=None):
+        now = now or self.clock()
+        return self._sun(now) > 0
+
+    def _update(self, now):
+        if self._day != now.date():
+            self._day = now.date()
+            self.kdy = 0.0
+            self.cac += 1
+        sun = self._sun(now)
+        pac = self.pin * sun
+        if self._last is not None and now > self._last:
+            hours = min((now - self._last).total_seconds(), 3600) / 3600
+            self.kdy += pac * hours / 1000
+            self.kt0 += pac * hours / 1000
+            self.khr += hours if pac > 0 else 0
+        self._last = now
+        return sun, pac
+
+    def getValues(self, now=None):
+        now = now or self.clock()
+        sun, pac = self._update(now)
+        pdc = pac / 0.96 if pac else 0.0
+        udc = [(550 + 50 * sun + self._random.uniform(-5, 5)) if sun else 0.0 for _ in range(3)]
+        ul = [230 + self._random.uniform(-3, 3) for _ in range(3)]
+        values = dict(self.DEFAULT_VALUES)
+        values.update({
+            'SDAT': now, 'FDAT': now.replace(year=now.year - 5), 'ADR': self.adr, 'MAC': self._mac,
+            'PIN': self.pin, 'SYS': '4E28,0' if sun else '4E21,0', 'CAC': self.cac,
+            'KDY': self.kdy, 'KYR': self.kt0 / 5, 'KLY': self.kt0 / 5, 'KMT': self.kt0 / 60, 'KLM': self.kt0 / 60,
+            'KT0': self.kt0, 'KHR': self.khr, 'PDC': pdc, 'PAC': pac, 'PRL': 100 * pac / self.pin,
+            'TNF': 50 + self._random.uniform(-0.05, 0.05), 'TKK': 25 + 30 * sun, 'DIN': '0',
+            'UL1': ul[0], 'UL2': ul[1], 'UL3': ul[2],
+            'UD01': udc[0], 'UD02': udc[1], 'UD03': udc[2]})
+        for i in range(3):
+            values[f"IL{i + 1}"] = pac / 3 / ul[i]
+            values[f"ID0{i + 1}"] = pdc / 3 / udc[i] if udc[i] else 0.0
+        return values
+
+    # the inverse of the decoder: hex values scaled by the response type, datetime as yyymmdd,seconds
+    @staticmethod
+    def encodeValue(key, value):
+        rt = sm13MT2.QUERY_MAP.get(key, {}).get('response_type', '')
+        if rt == 'datetime':
+            seconds = value.hour * 3600 + value.minute * 60 + value.second
+            return '%03X%02X%02X,%X' % (value.year, value.month, value.day, seconds)
+        if rt == '' or isinstance(value, str):
+            return str(value)
+        return '%X' % max(int(round(value / rt)), 0)
+
+    def answer(self, keys, now=None):
+        values = self.getValues(now)
+        return ';'.join(f"{key}={self.encodeValue(key, values[key])}" for key in keys if key in values)
+
+
+class inverterSimulator:
+
+    # units > 1 puts several inverters with the addresses 1..units on the bus behind each port, like an
+    # rs485 to tcp gateway. they answer requests for their own address only
+    def __init__(self, count=1, base_port=12345, host='127.0.0.1', faults=None, time_factor=1.0,
+                 start=None, seed=None, units=1, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.host = host
+        self.base_port = base_port
+        self.faults = faults or faultProfile()
+        self._random = random.Random(seed)
+        self._codec = communication('localhost', 0, autoconnect=False, logger=logger)
+
+        # simulated clock, time_factor > 1 runs days in minutes
+        self._t0 = time.monotonic()
+        self._start = start or datetime.now()
+        self.time_factor = time_factor
+
+        self.units = units
+        self.inverters = [virtualInverter(adr=i % units + 1, clock=self.now,
+                                          seed=None if seed is None else seed + i) for i in range(count * units)]
+        self._servers = []
+        self._tasks = set()  # the connection handlers, stop cancels these and nothing else of the loop
+        self._loop = None
+        self._thread = None
+
+        # statistics
+        self.requests = 0
+        self.faults_injected = 0
+
+    def now(self):
+        return self._start + timedelta(seconds=(time.monotonic() - self._t0) * self.time_factor)
+
+    def getPorts(self):
+        return [self.base_port + i for i in range(len(self.inverters) // self.units)]
+
+    # the inverters on the bus behind each port, by address
+    def getBuses(self):
+        return [{inverter.adr: inverter for inverter in self.inverters[i:i + self.units]}
+                for i in range(0, len(self.inverters), self.units)]
+
+    def _frame(self, inverter, dest, keys):
+        data = inverter.answer(keys)
+        body = f"{inverter.adr:02X};{dest};{len(data) + 19:02X}|64:{data}|"
+        checksum = self._codec._calcChecksum(body)
+        if self._random.random() < self.faults.bad_checksum:
+            self.faults_injected += 1
+            checksum = '%04X' % ((int(checksum, 16) + 1) & 0xFFFF)
+        return ('{' + body + checksum + '}').encode('utf8')
+
+    async def _write(self, writer, frame, previous):
+        faults = self.faults
+        if previous is not None and self._random.random() < faults.coalesce:
+            self.faults_injected += 1
+            frame = previous + frame
+        if len(frame) > 8 and self._random.random() < faults.split:
+            self.faults_injected += 1
+            cuts = sorted(self._random.sample(range(1, len(frame)), min(3, len(frame) - 1)))
+            for a, b in zip([0] + cuts, cuts + [len(frame)]):
+                writer.write(frame[a:b])
+                await writer.drain()
+                await asyncio.sleep(0.001)
+        else:
+            writer.write(frame)
+            await writer.drain()
+
+    async def _handle(self, bus, reader, writer):
+        faults = self.faults
+        inverter = next(iter(bus.values()))
+        if faults.offline_at_night and not inverter.isOnline():
+            writer.close()
+            return
+
+        frames = frameReader()
+        previous = None
+        self._tasks.add(asyncio.current_task())
+        try:
+            while True:
+                data = await reader.read(2048)
+                if not data:
+                    break
+                frames.feed(data)
+                request = frames.nextFrame()
+                while request is not None:
+                    if faults.offline_at_night and not inverter.isOnline():
+                        return
+                    if self._random.random() < faults.drop:
+                        self.faults_injected += 1
+                        return
+                    text = request.decode('utf8')
+                    source = text[1:3]
+                    inverter = bus.get(int(text[4:6], 16))
+                    if inverter is None:
+                        request = frames.nextFrame()  # nobody on the bus with this address, no answer
+                        continue
+                    keys = text[text.index(':') + 1:-6].split(';')
+                    if faults.latency or faults.jitter:
+                        await asyncio.sleep(faults.latency + self._random.random() * faults.jitter)
+                    frame = self._frame(inverter, source, keys)
+                    if faults.max_answer and len(frame) - 20 > faults.max_answer:
+                        request = frames.nextFrame()  # the answer does not fit into the device's frame buffer
+                        continue
+                    await self._write(writer, frame, previous)
+                    previous = frame
+                    self.requests += 1
+                    inverter.requests += 1
+                    request = frames.nextFrame()
+        except (ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass  # stop ends the connection, a clean shutdown, no traceback from the stream callback
+        finally:
+            self._tasks.discard(asyncio.current_task())
+            writer.close()
+
+    async def start(self):
+        ports = self.getPorts()
+        for bus, port in zip(self.getBuses(), ports):
+            server = await asyncio.start_server(lambda r, w, b=bus: self._handle(b, r, w), self.host, port)
+            self._servers.append(server)
+        self.log.info(f"simulating {len(self.inverters)} inverters on {self.host}:{self.base_port}"
+                      f"..{ports[-1]}, {self.units} per port")
+
+    async def stop(self):
+        for server in self._servers:
+            server.close()
+        # end the open connections too, only ours, the loop may run the caller's fleet or tests as well
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._servers = []
+
+    # runs the simulator in its own event loop thread, for tests of blocking code
+    def startInThread(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stopThread(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='simulate solarmax inverters')
+    parser.add_argument('--count', type=int, default=1, help='number of virtual inverters')
+    parser.add_argument('--units', type=int, default=1, help='inverters behind each port, addresses 1..units')
+    parser.add_argument('--base-port', type=int, default=12345, help='port of the first inverter')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--latency', type=float, default=0, help='answer latency in ms')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra latency in ms')
+    parser.add_argument('--split', type=float, default=0, help='probability of split answers')
+    parser.add_argument('--coalesce', type=float, default=0, help='probability of coalesced answers')
+    parser.add_argument('--bad-checksum', type=float, default=0, help='probability of bad checksums')
+    parser.add_argument('--drop', type=float, default=0, help='probability of dropped connections')
+    parser.add_argument('--max-answer', type=int, default=0, help='longest answer in data bytes, 0 = no limit')
+    parser.add_argument('--offline-at-night', action='store_true', help='refuse connections without sun')
+    parser.add_argument('--time-factor', type=float, default=1.0, help='speed of the simulated clock')
+    parser.add_argument('--start', default=None, help='simulated start time, e.g. 2024-06-04T05:00')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout,
+                        format='%(asctime)s %(levelname)s %(module)s/%(funcName)s: %(message)s')
+    profile = faultProfile(latency=args.latency / 1000, jitter=args.jitter / 1000, split=args.split,
+                           coalesce=args.coalesce, bad_checksum=args.bad_checksum, drop=args.drop,
+                           offline_at_night=args.offline_at_night, max_answer=args.max_answer)
+    simulator = inverterSimulator(count=args.count, base_port=args.base_port, host=args.host, faults=profile,
+                                  time_factor=args.time_factor, units=args.units,
+                                  start=datetime.fromisoformat(args.start) if args.start else None)
+
+    async def main():
+        await simulator.start()
+        while True:
+            await asyncio.sleep(60)
+            simulator.log.info(f"{simulator.requests} requests answered, {simulator.faults_injected} faults")
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
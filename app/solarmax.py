@@ -1,12 +1,30 @@
 # This module provides low layer functions to access the solarmax MT inverter
 import socket
+import time
 from datetime import datetime
 import json
 import logging
+import metrics
+import capture
 
 SOLARMAX_DATE_FORMAT = "%m/%d/%Y, %H:%M:%S"
 
 
+# datetime values are kept as objects on the way through the logger and formatted only when serialized
+def jsonDefault(o):
+    if isinstance(o, datetime):
+        return o.strftime(SOLARMAX_DATE_FORMAT)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+# date is yyymmdd and time is the seconds of the day, both in hex, e.g. 7E5070F,B4F0
+def decodeDateTime(s):
+    (date, time) = s.split(',')
+    time = int(time, 16)
+    return datetime(int(date[:3], 16), int(date[3:5], 16), int(date[5:], 16),
+                    time // 3600, (time % 3600) // 60, time % 60)
+
+
 class sm13MT2:
     # this map contains all command codes (keys), a readable name (name) and a unit field (response_type)
     # unsupported and not wanted commands are recommended to be commented out
@@ -92,28 +110,278 @@ class sm13MT2:
         'KDY'
     }
 
+    # parameter classes by rate of change: statics never or almost never change and are fetched once per
+    # session, slows are energy counters and the like, every other parameter is momentary
+    STATICS = {
+        'ADR', 'TYP', 'MAC', 'PIN', 'SWV', 'BDN', 'LAN', 'FDAT', 'DIN'}
+
+    SLOWS = {
+        'KDY', 'KYR', 'KLY', 'KMT', 'KLM', 'KT0', 'KHR', 'CAC'}
+
+    # fixed channel index of every key, the position of its value in a sample
+    CHANNELS = tuple(QUERY_MAP)
+    CHANNEL_INDEX = dict(zip(CHANNELS, range(len(CHANNELS))))
+
+    @staticmethod
+    def getParameterClass(key):
+        if key in sm13MT2.STATICS:
+            return 'static'
+        if key in sm13MT2.SLOWS:
+            return 'slow'
+        return 'momentary'
+
+
+# one cycle of one inverter as it travels from the query to the publishers and the storage. values are kept
+# by channel index, None where a key was not queried. samples are immutable, a zero-forced sample or a merge
+# with an earlier one is a new sample. the {'value': .., 'description': ..} per key form is only built by
+# toMessage when a sample leaves the logger as json
+class sample:
+    __slots__ = ('ts', 'device', 'values', 'flags')
+    FORCED_ZERO = 1  # momentaries forced to zero after the inverter went down, published as MOD=1
+
+    def __init__(self, ts, device, values, flags=0):
+        object.__setattr__(self, 'ts', ts)  # epoch seconds of SDAT, 0 if unknown
+        object.__setattr__(self, 'device', device)
+        object.__setattr__(self, 'values', values)  # tuple, one entry per sm13MT2.CHANNELS
+        object.__setattr__(self, 'flags', flags)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('samples are immutable')
+
+    # values is {key: value} as decoded, keys outside of the query map are ignored
+    @classmethod
+    def fromValues(cls, values, device='', flags=0):
+        row = [None] * len(sm13MT2.CHANNELS)
+        index = sm13MT2.CHANNEL_INDEX
+        for key, value in values.items():
+            i = index.get(key)
+            if i is not None:
+                row[i] = value
+        sdat = values.get('SDAT')
+        return cls(sdat.timestamp() if isinstance(sdat, datetime) else 0, device, tuple(row), flags)
+
+    def __len__(self):
+        return len(self.values) - self.values.count(None)
+
+    def __contains__(self, key):
+        i = sm13MT2.CHANNEL_INDEX.get(key)
+        return i is not None and self.values[i] is not None
+
+    def get(self, key, default=None):
+        i = sm13MT2.CHANNEL_INDEX.get(key)
+        value = self.values[i] if i is not None else None
+        return default if value is None else value
+
+    def items(self):
+        return [(key, value) for key, value in zip(sm13MT2.CHANNELS, self.values) if value is not None]
+
+    def keys(self):
+        return [key for key, value in zip(sm13MT2.CHANNELS, self.values) if value is not None]
+
+    @property
+    def time(self):
+        return self.get('SDAT')
+
+    @property
+    def mod(self):
+        return 1 if self.flags & self.FORCED_ZERO else 0
+
+    # the values of other where it has some, ours elsewhere
+    def merge(self, other):
+        values = tuple(o if o is not None else v for v, o in zip(self.values, other.values))
+        return sample(other.ts or self.ts, other.device, values, other.flags)
+
+    def select(self, keys):
+        keep = {sm13MT2.CHANNEL_INDEX[key] for key in keys if key in sm13MT2.CHANNEL_INDEX}
+        return sample(self.ts, self.device, tuple(v if i in keep else None for i, v in enumerate(self.values)),
+                      self.flags)
+
+    # the last sample with the momentary values set to zero, for the entry after the inverter went down
+    def forceZero(self, clear_dailys=False):
+        zero = sm13MT2.MOMENTARIES | sm13MT2.DAILYS if clear_dailys else sm13MT2.MOMENTARIES
+        values = tuple(0.0 if key in zero and v is not None else v for key, v in zip(sm13MT2.CHANNELS, self.values))
+        return sample(self.ts, self.device, values, self.flags | self.FORCED_ZERO)
+
+    def toMessage(self):
+        message = {key: {'value': value, 'description': sm13MT2.QUERY_MAP[key]['name']}
+                   for key, value in self.items()}
+        message['MOD'] = {'value': 1, 'description': 'momentaries forced to zero'} if self.mod \
+            else {'value': 0, 'description': 'non modified'}
+        return message
+
+
+# reassembles response frames from a tcp byte stream. a frame looks like {SS;DD;LL|64:data|CHKS}, where LL is
+# the length of the whole frame in hex (see communication._encodeRequest). responses may be split across several
+# segments or several frames may arrive at once, so bytes are buffered until a complete frame is available
+class frameReader:
+    HEADER_MAX = 16  # '{' + 'SS;DD;' + length field + '|', with some room for longer length fields
+
+    def __init__(self, max_buffer=65536):
+        self._buf = bytearray()
+        self.max_buffer = max_buffer
+
+    def feed(self, data):
+        self._buf += data
+        if len(self._buf) > self.max_buffer:
+            del self._buf[:len(self._buf) - self.max_buffer]
+
+    def clear(self):
+        self._buf.clear()
+
+    def pending(self):
+        return len(self._buf)
+
+    def _frameLength(self):
+        bar = self._buf.find(b'|', 0, self.HEADER_MAX)
+        if bar < 0:
+            return None if len(self._buf) < self.HEADER_MAX else 0
+        fields = bytes(self._buf[1:bar]).split(b';')
+        try:
+            return max(int(fields[2], 16), 0) if len(fields) == 3 else 0
+        except ValueError:
+            return 0
+
+    # returns the next complete frame as bytes, or None if more data is needed
+    def nextFrame(self):
+        while True:
+            start = self._buf.find(b'{')
+            if start < 0:
+                self._buf.clear()
+                return None
+            if start > 0:
+                del self._buf[:start]  # skip garbage in front of the frame
+
+            length = self._frameLength()
+            if length is None:
+                return None  # header incomplete
+            if length == 0:
+                del self._buf[:1]  # not a frame header, resync on the next '{'
+                continue
+
+            if length <= len(self._buf) and self._buf[length - 1] == ord('}'):
+                end = length
+            else:
+                # incomplete, or the length field does not match: fall back to the end of message indicator
+                end = self._buf.find(b'}') + 1
+                if end == 0:
+                    return None
+
+            frame = bytes(self._buf[:end])
+            del self._buf[:end]
+            return frame
+
+
+# decodes response payloads with one converter per key, compiled once from a query map:
+#   'datetime' -> datetime object, '' -> raw string, number -> hex value times scale
+class responseDecoder:
+
+    def __init__(self, querymap=None):
+        if querymap is None:
+            querymap = sm13MT2.QUERY_MAP
+        self._table = {}
+        for key, entry in querymap.items():
+            rt = entry['response_type']
+            if rt == 'datetime':
+                convert = decodeDateTime
+            elif rt == '':
+                convert = str
+            else:
+                convert = self._hexScale(float(rt))
+            self._table[key] = convert
+
+        # fields of the last decoded payload which could not be decoded
+        self.unknown = []
+        self.malformed = []
+
+    @staticmethod
+    def _hexScale(scale):
+        return lambda val: round(int(val, 16) * scale, 3)
+
+    # data is a complete frame {SS;DD;LL|64:KEY=VAL;KEY=VAL|CHKS}, returns {key: value}
+    def decode(self, data):
+        self.unknown = []
+        self.malformed = []
+        start = data.find(':') + 1
+        if start == 0 or len(data) < start + 6:
+            raise ValueError('bad data format')
+
+        asDict = {}
+        payload = data[start:-6]
+        if not payload:
+            return asDict  # the answer to a chunk without any key the inverter supports
+        table = self._table
+        for field in payload.split(';'):
+            key, sep, val = field.partition('=')
+            convert = table.get(key)
+            if convert is None:
+                self.unknown.append(field)
+                continue
+            try:
+                if not sep:
+                    raise ValueError
+                asDict[key] = convert(val)
+            except (ValueError, IndexError):
+                self.malformed.append(field)
+        return asDict
+
+
+# a command list prepared for querying, built once and replayed on every cycle: the chunks with their
+# encoded request frames and the keys expected back
+class queryPlan:
+
+    def __init__(self, con, commandlist, maxcommands):
+        self.commands = tuple(commandlist)
+        self.chunks = con._chunkCommand(list(self.commands), maxcommands)
+        self.frames = [con._encodeRequest(chunk) for chunk in self.chunks]
+        self.expected = [frozenset(chunk) for chunk in self.chunks]
+        self.keys = frozenset(self.commands)
+        self.unanswered = set()  # keys missing in the last answer
+
+    # keys requested but not answered. the size alone cannot tell, a late answer may add keys of another chunk,
+    # so this is one set difference, done in C and about 4x faster than a python loop over the keys
+    def missing(self, decoded):
+        return self.keys.difference(decoded)
+
 
 class communication:
+    MAX_STALE_FRAMES = 2  # responses to earlier requests skipped while waiting for an answer
 
-    def __init__(self, ip, port, adr=1, maxc=20, device_type='sm13MT2', logger='__main__'):
+    def __init__(self, ip, port, adr=1, maxc=20, device_type='sm13MT2', logger='__main__', autoconnect=True):
         self.log = logging.getLogger(logger)
         self._ip = ip
         self._port = int(port)
-        self._adr = adr
+        self._adr = int(adr)
         self._devicetype = device_type
         self.response = ""
-        self.decodeddata = {}
-        self.decodeddata_last = {}
+        self.decodeddata = {}  # {key: value} of the running query, see getSample
         self.commandmap = sm13MT2.QUERY_MAP.copy()
+        self._decoder = responseDecoder(self.commandmap)
         self.maxcommands = maxc
+        self.supported = None  # keys the device answers, None until probed, see capability.py
+        self._plans = {}
         self._socket = None
         self._connected = False
-        self._connect()
+        self._frames = frameReader()
+        self._recvbuf = bytearray(2048)
+        self.capture = None  # optional capture.frameCapture, records every raw frame
+        if autoconnect:
+            self._connect()
         self.log.debug('Communication socket to %s:%s initialized' % (ip, port))
 
     def __del__(self):
         self._disconnect()
 
+    # public connection handling, used by long living sessions which keep the socket open across queries
+    def connect(self):
+        self._connect()
+        return self._connected
+
+    def disconnect(self):
+        self._disconnect()
+
+    def isConnected(self):
+        return self._connected and self._socket is not None
+
     def getCommandList(self):
         return list(self.commandmap.keys())
 
@@ -123,10 +391,6 @@ class communication:
     def _chunkCommand(self, l, n):
         return [l[i:i + n] for i in range(0, len(l), n)]
 
-    def _difflist(self, li1, li2):
-        li_dif = [i for i in li1 + li2 if i not in li1 or i not in li2]
-        return li_dif
-
     # calculates the checksum: the checksum field is a standard 16-bit checksum over the body:
     #   the first character is the source address, the last character is the ‘|’ before the checksum
     def _calcChecksum(self, s):
@@ -148,16 +412,7 @@ class communication:
             return False
 
     def _decodeDateTime(self, s):
-        (date, time) = s.split(',')
-        time = int(time, 16)
-        year = int(date[:3], 16)
-        month = int(date[3:5], 16)
-        day = int(date[5:], 16)
-        hour = int(time / 3600)
-        minute = int((time % 3600) / 60)
-        second = int((time % 60))
-
-        return datetime(year, month, day, hour, minute, second)
+        return decodeDateTime(s)
 
     def getResponsePayload(self):
         if len(self.response) > 5:
@@ -180,7 +435,7 @@ class communication:
     def _encodeRequest(self, commandlist):
 
         SOURCE_ADR = u'FB' + ';'
-        DEST_ADR = u'01' + ';'
+        DEST_ADR = u'%02X;' % self._adr  # bus address of the inverter, several may share one gateway
 
         # calculate msg len
         f = lambda x: str(hex(sum([len(i) for i in x]) + (len(x) - 1) * 1 + 19)[2:]).upper()
@@ -206,11 +461,13 @@ class communication:
         self._disconnect()
         self.log.debug('try to connect %s:%i ...' % (self._ip, self._port))
         try:
-            self._socket = socket.create_connection((self._ip, self._port), 5)
+            with metrics.CONNECT_SECONDS.time():
+                self._socket = socket.create_connection((self._ip, self._port), 5)
             self._connected = True
             self.log.debug('connected to %s:%i ok' % (self._ip, self._port))
         except socket.error as msg:
             self.log.debug("connection failed: " + str(msg))
+            metrics.CONNECT_FAILURES.inc()
             self._connected = False
 
     def _disconnect(self):
@@ -218,45 +475,33 @@ class communication:
             # DEBUG('Closing open connection to %s:%s...' % (self._ip, self._port))
             self._socket.shutdown(socket.SHUT_RDWR)
             self._socket.close()
-            del self.__socket
         except:
             pass
         finally:
             self._connected = False
             self._socket = None
+            self._frames.clear()
 
     def _decode(self, data):
-        asDict = {}
-
         try:
-            asArray = data[:-6].split(':')[1].split(';')
-        except:
+            with metrics.DECODE_SECONDS.time():
+                asDict = self._decoder.decode(data)
+        except ValueError:
             self.log.error('decoding failed, bad data format: %s' % (data))
             return {}
 
-        for i in range(0, len(asArray)):
-            try:
-                key = asArray[i].split("=")[0]
-                val = asArray[i].split("=")[1]
-                rt = self.commandmap[key]['response_type']
-                name = self.commandmap[key]['name']
-                if rt == 'datetime':
-                    # asDict[key]={'value' : self._decodeDateTime(val), 'description': name, }
-                    asDict[key] = {'value': self._decodeDateTime(val).strftime(SOLARMAX_DATE_FORMAT),
-                                   'description': name, }
-                    # strftime("%m/%d/%Y, %H:%M:%S")
-                elif rt == '':
-                    asDict[key] = {'value': val, 'description': name, }
-                else:
-                    asDict[key] = {'value': round(float(int(val, 16)) * rt, 3), 'description': name, }
-            except:
-                pass
-
+        if self._decoder.unknown:
+            self.log.warning('unknown fields in response: %s' % self._decoder.unknown)
+        if self._decoder.malformed:
+            self.log.warning('malformed fields in response: %s' % self._decoder.malformed)
         return asDict
 
     def _send(self, s):
         try:
-            self._socket.send(s)
+            with metrics.SEND_SECONDS.time():
+                self._socket.send(s)
+            if self.capture is not None:
+                self.capture.record(capture.REQUEST, s)
         except socket.timeout:
             self.log.warning('sending timeout %s:%i' % (self._ip, self._port))
             self._connected = False
@@ -264,69 +509,140 @@ class communication:
             self.log.error('sending socket error %s:%i' % (self._ip, self._port))
             self._connected = False
 
+    # read until a complete frame is buffered, responses may be split across several tcp segments
     def _receive(self):
-        resp = b''
+        frame = self._frames.nextFrame()  # frames may have arrived together with the previous one
+        view = memoryview(self._recvbuf)
+        started = time.perf_counter()
         try:
-            buf = self._socket.recv(2048)
-            if len(buf) > 0:
-                resp = resp + buf
-                self.response = resp.decode('utf8')
-                return self.response
-            else:
-                return ""
-        except:
+            while frame is None:
+                n = self._socket.recv_into(self._recvbuf)
+                if n == 0:
+                    self.log.warning('connection closed by %s:%i' % (self._ip, self._port))
+                    self._connected = False
+                    return ""
+                self._frames.feed(view[:n])
+                frame = self._frames.nextFrame()
+        except socket.timeout:
+            self.log.error('receive timeout %s:%i' % (self._ip, self._port))
+            return ""
+        except (socket.error, AttributeError):
             self.log.error('receive error')
             return ""
+        finally:
+            view.release()
+            metrics.RECEIVE_SECONDS.observe(time.perf_counter() - started)
 
-    def _subquery(self, commandlist):
+        if self.capture is not None:
+            self.capture.record(capture.RESPONSE, frame)
+        self.response = frame.decode('utf8', 'replace')  # a garbled byte fails the checksum instead of raising
+        return self.response
 
-        if not self._connected:
-            self.log.debug('query not sent - no connection')
+    # validate a response frame and merge its values into the decoded data, shared with the asyncio fleet engine.
+    # expected are the keys of the request, a response without any of them belongs to another (stale) request
+    # and None is returned, so the caller can wait for the right one
+    def _handleResponse(self, response, expected=None):
+        self.response = response
+
+        # validate checksum and append to decoded data
+        if not self._validateChecksum(self.response):
+            self.log.error('bad receive checksum')
+            metrics.CHECKSUM_FAILURES.inc()
             return False
 
-        # encode command and send query
-        self._send(self._encodeRequest(commandlist))
+        # behind a gateway the answer of another unit may still be on its way, the source address tells
+        if self._sourceAddress(self.response) != self._adr:
+            self.log.warning('response from address %s, expected %i, skip it' % (self.response[1:3], self._adr))
+            return None
 
-        # receive data
-        self.response = self._receive()
+        # an empty answer is the inverter's reply to a chunk of keys it does not support, only values of other
+        # keys mark the answer to another request
+        decoded = self._decode(self.response)
+        if expected is not None and decoded and expected.isdisjoint(decoded):
+            self.log.warning('response does not match the request, skip it')
+            return None
 
-        # DEBUG(self.response)
+        if self.decodeddata == {}:
+            self.log.debug('receive ok (1)')
+        else:
+            self.log.debug('receive ok (2)')
+        self.decodeddata.update(decoded)
+        return True
 
-        # validate checksum and append to decoded data
-        if self._validateChecksum(self.response):
-            status = True
-            if self.decodeddata == {}:
-                self.log.debug('receive ok (1)')
-            else:
-                self.log.debug('receive ok (2)')
-            self.decodeddata.update(self._decode(self.response))
+    @staticmethod
+    def _sourceAddress(response):
+        try:
+            return int(response[1:3], 16)
+        except ValueError:
+            return None
 
-        else:
-            self.log.error('bad receive checksum')
-            status = False
+    # clear decoded data buffer, the logger keeps the last sample itself
+    def _beginQuery(self):
+        self.decodeddata = {}
+
+    # the result of a capability probe, later plans request the supported keys only and chunk them by the
+    # largest request the device answered
+    def setCapabilities(self, supported, maxcommands):
+        self.supported = frozenset(supported)
+        self.maxcommands = maxcommands
+        self._plans.clear()
+
+    # plans are cached per command list, the list rarely changes between cycles
+    def getPlan(self, commandlist):
+        key = (tuple(commandlist), self.maxcommands)
+        plan = self._plans.get(key)
+        if plan is None:
+            if len(self._plans) >= 64:
+                self._plans.clear()
+            if self.supported is not None:
+                commandlist = [c for c in commandlist if c in self.supported] or commandlist
+            plan = self._plans[key] = queryPlan(self, commandlist, self.maxcommands)
+        return plan
+
+    # warns once per plan, the same keys stay unanswered on every cycle
+    def _checkSupported(self, plan):
+        missing = plan.missing(self.decodeddata)
+        if missing:
+            metrics.UNSUPPORTED_PARAMS.inc(len(missing))
+            if missing != plan.unanswered:
+                self.log.warning('unsupported params %s' % sorted(missing))
+            plan.unanswered = missing
+
+    def _subquery(self, frame, expected=None):
 
-        return status
+        if not self._connected:
+            self.log.debug('query not sent - no connection')
+            return False
+
+        # send the pre-encoded query
+        self._send(frame)
+
+        # receive data, validate and decode. a late answer to an earlier request may arrive first
+        for _ in range(self.MAX_STALE_FRAMES + 1):
+            status = self._handleResponse(self._receive(), expected)
+            if status is not None:
+                return status
+        return False
 
     def query(self, commandlist):
 
-        # clear decoded data buffer (and save last)
-        self.decodeddata_last = self.decodeddata.copy()
-        self.decodeddata = {}
+        self._beginQuery()
 
-        # split command into chunks because solarmax respond to max 20 commands at once
-        cmdchunks = self._chunkCommand(commandlist, self.maxcommands)
+        # the plan splits the commands into chunks because solarmax respond to max 20 commands at once
+        plan = self.getPlan(commandlist)
 
         # now, call for data
-        for cmds in cmdchunks:
-            status = self._subquery(cmds)
-            if not status:
+        for frame, expected in zip(plan.frames, plan.expected):
+            if not self._subquery(frame, expected):
                 return False
 
-        delta = self._difflist(commandlist, list(self.decodeddata.keys()))
-        if len(delta) > 0:
-            self.log.warning('unsupported params', delta)
+        self._checkSupported(plan)
+
+        return True
 
-        return status
+    # the decoded values of the last query as a sample, the device is the inverter's name in the logger
+    def getSample(self, device=''):
+        return sample.fromValues(self.decodeddata, device)
 
     def getDataAsJson(self):
-        return json.dumps(self.decodeddata, sort_keys=True)  # convert string to json
+        return json.dumps(self.getSample().toMessage(), sort_keys=True, default=jsonDefault)  # convert string to json
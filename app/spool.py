@@ -0,0 +1,108 @@
+# This module spools mqtt batches to disk while the broker is unreachable and hands them back for replay
+import os
+import json
+import base64
+import sqlite3
+import threading
+import time
+import logging
+
+
+# binary payloads (compact cycle messages) are kept as base64 with a marker, text payloads as they are
+def _dumpBatch(batch):
+    return json.dumps([(topic, base64.b64encode(payload).decode('ascii'), 'b64') if isinstance(payload, bytes)
+                       else (topic, payload) for topic, payload in batch])
+
+
+def _loadBatch(text):
+    return [(item[0], base64.b64decode(item[1])) if len(item) > 2 else tuple(item) for item in json.loads(text)]
+
+
+class batchSpool:
+    # eviction policies once max_batches is reached: drop the oldest batch, or refuse the new one
+    EVICT_OLDEST = 'oldest'
+    EVICT_NEWEST = 'newest'
+
+    def __init__(self, path='./data/spool.db', max_batches=100000, eviction=EVICT_OLDEST, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.path = path
+        self.max_batches = max_batches
+        self.eviction = eviction
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # append only table in wal mode, the logger and the heartbeat thread share the connection
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'created REAL NOT NULL, batch TEXT NOT NULL)')
+        self._depth = self._db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+        if self._depth:
+            self.log.info(f"spool {path} holds {self._depth} batches from a previous run")
+
+        # statistics
+        self.spooled = 0
+        self.evicted = 0
+        self.replayed = 0
+        self.drain_rate = 0.0  # batches per second of the last replay
+
+    @classmethod
+    def fromConfig(cls, config, logger='__main__'):
+        section = config['SPOOL']
+        return cls(path=section.get('Path', './data/spool.db'), max_batches=int(section.get('MaxBatches', '100000')),
+                   eviction=section.get('Eviction', cls.EVICT_OLDEST), logger=logger)
+
+    def depth(self):
+        return self._depth
+
+    def getStats(self):
+        return {'depth': self._depth, 'spooled': self.spooled, 'evicted': self.evicted, 'replayed': self.replayed,
+                'drain_rate': round(self.drain_rate, 1)}
+
+    # batch is a list of (topic, payload) pairs, payloads keep their original SDAT
+    def append(self, batch):
+        with self._lock:
+            if self._depth >= self.max_batches:
+                if self.eviction == self.EVICT_NEWEST:
+                    self.evicted += 1
+                    return False
+                excess = self._depth - self.max_batches + 1
+                self._db.execute('DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)', (excess,))
+                self._depth -= excess
+                self.evicted += excess
+            self._db.execute('INSERT INTO spool (created, batch) VALUES (?, ?)', (time.time(), _dumpBatch(batch)))
+            self._depth += 1
+            self.spooled += 1
+        return True
+
+    # hands the oldest batches to send, which returns the messages it could not send. a batch is removed from the
+    # spool once all of its messages went out, after a partial failure only the failed ones are kept
+    def replay(self, send, max_batches=50):
+        with self._lock:
+            if self._depth == 0:
+                return 0
+            started = time.monotonic()
+            rows = self._db.execute('SELECT id, batch FROM spool ORDER BY id LIMIT ?', (max_batches,)).fetchall()
+            done = []
+            for rowid, batch in rows:
+                batch = _loadBatch(batch)
+                failed = send(batch)
+                if failed:
+                    if len(failed) < len(batch):
+                        self._db.execute('UPDATE spool SET batch = ? WHERE id = ?', (_dumpBatch(failed), rowid))
+                    break
+                done.append((rowid,))
+            if done:
+                self._db.execute('BEGIN')
+                self._db.executemany('DELETE FROM spool WHERE id = ?', done)
+                self._db.execute('COMMIT')
+                self._depth -= len(done)
+                self.replayed += len(done)
+                self.drain_rate = len(done) / max(time.monotonic() - started, 1e-6)
+            return len(done)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,87 @@
+# This module plans the waiting time of an unresponsive inverter around the local sunrise and sunset.
+# sun times come from the sunrise equation for the configured position, no network access is needed:
+#   night                      sleep until WakeBefore seconds ahead of the next sunrise
+#   sunrise +/- wake window    probe every ProbeStep seconds
+#   day                        the logger's exponential backoff
+import math
+import logging
+from datetime import datetime, timedelta, timezone
+
+_J2000 = datetime(2000, 1, 1, 12, tzinfo=timezone.utc)  # julian day 2451545.0
+
+
+# sunrise and sunset of a day in utc, (None, None) in polar night and (None, True) in midnight sun.
+# elevation is the sun's center below the horizon at rise and set, -0.833 corrects refraction and disc radius
+def getSunTimes(day, latitude, longitude, elevation=-0.833):
+    n = (datetime(day.year, day.month, day.day, 12, tzinfo=timezone.utc) - _J2000).days
+    j = n - longitude / 360  # mean solar noon, longitude east positive
+    m = math.radians((357.5291 + 0.98560028 * j) % 360)
+    c = 1.9148 * math.sin(m) + 0.02 * math.sin(2 * m) + 0.0003 * math.sin(3 * m)
+    ecliptic = math.radians((math.degrees(m) + c + 180 + 102.9372) % 360)
+    transit = j + 0.0053 * math.sin(m) - 0.0069 * math.sin(2 * ecliptic)
+    declination = math.asin(math.sin(ecliptic) * math.sin(math.radians(23.4397)))
+
+    phi = math.radians(latitude)
+    cos_omega = ((math.sin(math.radians(elevation)) - math.sin(phi) * math.sin(declination))
+                 / (math.cos(phi) * math.cos(declination)))
+    if cos_omega > 1:
+        return None, None
+    if cos_omega < -1:
+        return None, True
+    omega = math.degrees(math.acos(cos_omega)) / 360
+    return _J2000 + timedelta(days=transit - omega), _J2000 + timedelta(days=transit + omega)
+
+
+class sunScheduler:
+
+    def __init__(self, latitude, longitude, wake_before=1800, wake_after=3600, sleep_after=1800, probe_step=30,
+                 logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.latitude = latitude
+        self.longitude = longitude
+        self.wake_before = timedelta(seconds=wake_before)  # start probing this long before sunrise
+        self.wake_after = timedelta(seconds=wake_after)  # and keep probing tightly this long after it
+        self.sleep_after = timedelta(seconds=sleep_after)  # the inverter may still answer a while after sunset
+        self.probe_step = probe_step
+
+    @classmethod
+    def fromConfig(cls, config, logger='__main__'):
+        section = config['SUN']
+        return cls(latitude=float(section['Latitude']), longitude=float(section['Longitude']),
+                   wake_before=int(section.get('WakeBefore', '1800')),
+                   wake_after=int(section.get('WakeAfter', '3600')),
+                   sleep_after=int(section.get('SleepAfterSunset', '1800')),
+                   probe_step=int(section.get('ProbeStep', '30')), logger=logger)
+
+    # wake window and start of the night for day, None if the sun does not rise or set that day
+    def _window(self, day):
+        sunrise, sunset = getSunTimes(day, self.latitude, self.longitude)
+        if sunrise is None:
+            return None
+        return sunrise - self.wake_before, sunrise + self.wake_after, sunset + self.sleep_after
+
+    # waiting time in seconds for an inverter that did not answer, backoff is the logger's own proposal
+    def getWaitingTime(self, backoff, now=None):
+        now = now or datetime.now(timezone.utc)
+        today = now.astimezone().date()
+        window = self._window(today)
+        if window is None:
+            # polar day keeps the backoff, in polar night look again in a few hours
+            polar_day = getSunTimes(today, self.latitude, self.longitude)[1] is True
+            return backoff if polar_day else max(backoff, 6 * 3600)
+
+        wake_start, wake_end, sleep_start = window
+        if now < wake_start:
+            return self._sleepUntil(now, wake_start)
+        if now <= wake_end:
+            return min(backoff, self.probe_step)
+        if now >= sleep_start:
+            tomorrow = self._window(today + timedelta(days=1))
+            if tomorrow is not None:
+                return self._sleepUntil(now, tomorrow[0])
+        return backoff
+
+    def _sleepUntil(self, now, wake):
+        seconds = max(int((wake - now).total_seconds()), self.probe_step)
+        self.log.info(f"night, sleep {seconds} seconds until {wake.astimezone().isoformat(timespec='minutes')}")
+        return seconds
@@ -0,0 +1,178 @@
+# This module keeps a local history of the momentary and daily channels in compact columnar day segments:
+#   <root>/<device>/<yyyy-mm-dd>/<KEY>.t   epoch seconds, uint32
+#   <root>/<device>/<yyyy-mm-dd>/<KEY>.v   values, float32
+# samples are buffered in arrays and appended in blocks to spare the sd card, reads are memory mapped
+import os
+import mmap
+import shutil
+import bisect
+import logging
+from array import array
+from datetime import datetime, timedelta
+from solarmax import sm13MT2, sample
+
+
+class _segment:
+    # one channel of one day, read only view on the flushed part of the files
+
+    def __init__(self, path):
+        self._maps = []
+        self._views = []
+        self.t, self.v = array('I'), array('f')
+        if os.path.exists(path + '.t') and os.path.getsize(path + '.t') > 0:
+            t = self._map(path + '.t', 'I')
+            v = self._map(path + '.v', 'f')
+            n = min(len(t), len(v))  # a torn write leaves one file shorter
+            self.t, self.v = self._view(t[:n]), self._view(v[:n])
+
+    def _view(self, view):
+        self._views.append(view)
+        return view
+
+    def _map(self, path, fmt):
+        with open(path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(m)
+        raw = self._view(memoryview(m))
+        return self._view(raw[:len(raw) - len(raw) % 4].cast(fmt))
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        for m in self._maps:
+            m.close()
+
+
+class timeSeriesStore:
+    CHANNELS = sm13MT2.MOMENTARIES | sm13MT2.DAILYS
+
+    def __init__(self, root='./data/ts', device='default', flush_samples=60, retention_days=400,
+                 channels=None, logger='__main__'):
+        self.log = logging.getLogger(logger)
+        self.root = os.path.join(root, device)
+        self.flush_samples = flush_samples
+        self.retention_days = retention_days
+        self.channels = set(channels) if channels is not None else set(self.CHANNELS)
+        self._day = None
+        self._buffer = {}  # key -> (array of times, array of values), not yet on disk
+        self._pending = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def fromConfig(cls, config, device='default', logger='__main__'):
+        section = config['STORE']
+        return cls(root=section.get('Path', './data/ts'), device=device,
+                   flush_samples=int(section.get('FlushSamples', '60')),
+                   retention_days=int(section.get('RetentionDays', '400')), logger=logger)
+
+    def _dayPath(self, day):
+        return os.path.join(self.root, day.isoformat())
+
+    # the time of a sample is taken from SDAT
+    def append(self, sample: sample):
+        sdat = sample.time
+        if not isinstance(sdat, datetime):
+            return
+        if sdat.date() != self._day:
+            self.flush()
+            self._day = sdat.date()
+            self._expire()
+        ts = int(sample.ts)
+
+        channels = self.channels
+        for key, value in sample.items():
+            if key not in channels or not isinstance(value, (int, float)):
+                continue
+            columns = self._buffer.get(key)
+            if columns is None:
+                columns = self._buffer[key] = (array('I'), array('f'))
+            columns[0].append(ts)
+            columns[1].append(value)
+
+        self._pending += 1
+        if self._pending >= self.flush_samples:
+            self.flush()
+
+    def flush(self):
+        if self._day is None or not self._buffer:
+            return
+        path = self._dayPath(self._day)
+        os.makedirs(path, exist_ok=True)
+        for key, (times, values) in self._buffer.items():
+            # the value column is written first, a torn write then shows up as a shorter time column
+            with open(os.path.join(path, key + '.v'), 'ab') as f:
+                values.tofile(f)
+            with open(os.path.join(path, key + '.t'), 'ab') as f:
+                times.tofile(f)
+        self._buffer = {}
+        self._pending = 0
+
+    def _expire(self):
+        if not self.retention_days:
+            return
+        oldest = (self._day - timedelta(days=self.retention_days)).isoformat()
+        for name in os.listdir(self.root):
+            if name < oldest:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+                self.log.info(f"removed expired time series segment {name}")
+
+    def getDays(self):
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+    # raw samples of a channel as (epoch seconds, value), start inclusive and end exclusive
+    def query(self, key, start: datetime, end: datetime):
+        t0, t1 = int(start.timestamp()), int(end.timestamp())
+        out = []
+        day = start.date()
+        while day <= end.date():
+            segment = _segment(os.path.join(self._dayPath(day), key))
+            try:
+                lo, hi = bisect.bisect_left(segment.t, t0), bisect.bisect_left(segment.t, t1)
+                out.extend(zip(segment.t[lo:hi].tolist(), [round(v, 3) for v in segment.v[lo:hi].tolist()]))
+            finally:
+                segment.close()
+            if day == self._day and key in self._buffer:
+                times, values = self._buffer[key]
+                out.extend((t, round(v, 3)) for t, v in zip(times, values) if t0 <= t < t1)
+            day += timedelta(days=1)
+        return out
+
+    # averages of a channel over buckets of step seconds, as (bucket start, mean, min, max, count)
+    def downsample(self, key, start: datetime, end: datetime, step=300):
+        buckets = {}
+        for t, v in self.query(key, start, end):
+            b = t - t % step
+            agg = buckets.get(b)
+            if agg is None:
+                buckets[b] = [v, v, v, 1]
+            else:
+                agg[0] += v
+                agg[1] = min(agg[1], v)
+                agg[2] = max(agg[2], v)
+                agg[3] += 1
+        return [(b, round(s / n, 3), lo, hi, n) for b, (s, lo, hi, n) in sorted(buckets.items())]
+
+    def close(self):
+        self.flush()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='query the local time series store')
+    parser.add_argument('key', help='channel, e.g. PAC')
+    parser.add_argument('start', help='start, e.g. 2024-06-04 or 2024-06-04T12:00')
+    parser.add_argument('end', help='end (exclusive)')
+    parser.add_argument('--root', default='./data/ts', help='store directory')
+    parser.add_argument('--device', default='default', help='device name, the inverter section suffix')
+    parser.add_argument('--step', type=int, default=0, help='downsample to buckets of step seconds')
+    args = parser.parse_args()
+
+    store = timeSeriesStore(root=args.root, device=args.device)
+    start, end = datetime.fromisoformat(args.start), datetime.fromisoformat(args.end)
+    if args.step:
+        for row in store.downsample(args.key, start, end, args.step):
+            print(datetime.fromtimestamp(row[0]).isoformat(), *row[1:])
+    else:
+        for t, v in store.query(args.key, start, end):
+            print(datetime.fromtimestamp(t).isoformat(), v)
@@ -0,0 +1,83 @@
+# Microbenchmark of the table driven response decoder against the former communication._decode
+#   python3 benchmarks/bench_decode.py [--number N]
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from solarmax import SOLARMAX_DATE_FORMAT, sm13MT2, communication, decodeDateTime  # noqa: E402
+
+# response values for every key of the query map, in the format the inverter answers with
+SAMPLE_VALUES = {'SDAT': '7E5070F,B4F0', 'FDAT': '7DA0A01,8CA0', 'ADR': '1', 'TYP': '4E28', 'MAC': '0012A5C3',
+                 'PIN': '32C8', 'SYS': '4E28,0', 'SAL': '0', 'LAN': '1', 'SWV': 'E0', 'BDN': '7D4', 'CAC': '1F4',
+                 'KDY': '1E', 'KYR': '1A2B', 'KLY': '2B3C', 'KMT': '1F4', 'KLM': '258', 'KT0': 'C350',
+                 'KHR': '4E20', 'PDC': '2710', 'PAC': '2580', 'PRL': '3C', 'TNF': '1388', 'TKK': '2D',
+                 'UL1': '8FC', 'UL2': '901', 'UL3': '8F7', 'IL1': '1F4', 'IL2': '1F0', 'IL3': '1F8',
+                 'UD01': '1770', 'UD02': '1772', 'UD03': '176E', 'ID01': '258', 'ID02': '256', 'ID03': '25A',
+                 'DIN': '0'}
+
+
+def makeResponse(keys):
+    con = communication('localhost', 0, autoconnect=False)
+    data = ';'.join(f"{key}={SAMPLE_VALUES.get(key, '0')}" for key in keys)
+    body = f"01;FB;{len(data) + 19:02X}|64:{data}|"
+    return '{' + body + con._calcChecksum(body) + '}'
+
+
+# the decoder as it was before it became table driven
+def legacyDecode(commandmap, data):
+    asDict = {}
+
+    try:
+        asArray = data[:-6].split(':')[1].split(';')
+    except:
+        return {}
+
+    for i in range(0, len(asArray)):
+        try:
+            key = asArray[i].split("=")[0]
+            val = asArray[i].split("=")[1]
+            rt = commandmap[key]['response_type']
+            name = commandmap[key]['name']
+            if rt == 'datetime':
+                asDict[key] = {'value': decodeDateTime(val).strftime(SOLARMAX_DATE_FORMAT),
+                               'description': name, }
+            elif rt == '':
+                asDict[key] = {'value': val, 'description': name, }
+            else:
+                asDict[key] = {'value': round(float(int(val, 16)) * rt, 3), 'description': name, }
+        except:
+            pass
+
+    return asDict
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark response decoding')
+    parser.add_argument('--number', type=int, default=20000, help='decodes per measurement')
+    args = parser.parse_args()
+
+    con = communication('localhost', 0, autoconnect=False)
+    commandmap = sm13MT2.QUERY_MAP
+    chunks = con.getPlan(list(commandmap.keys())).chunks
+    responses = [makeResponse(chunk) for chunk in chunks]
+
+    # both decoders have to agree on the values, except for the datetime representation
+    for response in responses:
+        new = con._decode(response)
+        for key, entry in legacyDecode(commandmap, response).items():
+            value = new[key]
+            if commandmap[key]['response_type'] == 'datetime':
+                value = value.strftime(SOLARMAX_DATE_FORMAT)
+            assert value == entry['value'], key
+
+    fields = sum(len(chunk) for chunk in chunks)
+    for name, func in (('legacy', lambda: [legacyDecode(commandmap, r) for r in responses]),
+                       ('table', lambda: [con._decode(r) for r in responses])):
+        best = min(timeit.repeat(func, number=args.number, repeat=5))
+        print(f"{name:8s} {best / args.number * 1e6:8.2f} us/cycle {best / args.number / fields * 1e9:8.1f} ns/field")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# A minimal MQTT 3.1.1 stand-in for benchmarks: accepts connects, acknowledges publishes and counts them.
+# no subscriptions, no retained messages, no persistence
+import asyncio
+import threading
+
+
+class mqttStandIn:
+    CONNECT, CONNACK, PUBLISH, PUBACK, PINGREQ, PINGRESP, DISCONNECT = 1, 2, 3, 4, 12, 13, 14
+
+    def __init__(self, host='127.0.0.1', port=18830, latency=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency  # seconds before a connack, to emulate a slow broker
+        self.connects = 0
+        self.messages = 0
+        self.bytes = 0
+        self._server = None
+        self._tasks = set()  # the connection handlers, stop cancels these and nothing else of the loop
+        self._loop = None
+        self._thread = None
+
+    async def _packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length, shift = 0, 0
+        while True:
+            b = (await reader.readexactly(1))[0]
+            length += (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        return header, await reader.readexactly(length)
+
+    async def _handle(self, reader, writer):
+        self._tasks.add(asyncio.current_task())
+        try:
+            while True:
+                header, body = await self._packet(reader)
+                kind = header >> 4
+                if kind == self.CONNECT:
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    self.connects += 1
+                    writer.write(bytes([self.CONNACK << 4, 2, 0, 0]))
+                elif kind == self.PUBLISH:
+                    self.messages += 1
+                    self.bytes += len(body)
+                    qos = (header >> 1) & 3
+                    if qos:
+                        n = int.from_bytes(body[:2], 'big')
+                        writer.write(bytes([self.PUBACK << 4, 2]) + body[2 + n:4 + n])
+                elif kind == self.PINGREQ:
+                    writer.write(bytes([self.PINGRESP << 4, 0]))
+                elif kind == self.DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass  # stop ends the connection, a clean shutdown, no traceback from the stream callback
+        finally:
+            self._tasks.discard(asyncio.current_task())
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self):
+        self._server.close()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def startInThread(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stopThread(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -0,0 +1,198 @@
+# Benchmark suite for the poll-decode-publish path, results are written as json for comparison between versions
+#   python3 benchmarks/suite.py micro                      codec micro benchmarks
+#   python3 benchmarks/suite.py cycle --duration 60        end-to-end logging cycles against local stand-ins
+#   python3 benchmarks/suite.py cycle --legacy             the same with a new connection and mqtt client per cycle
+#   python3 benchmarks/suite.py all --output results.json
+import os
+import sys
+import json
+import time
+import timeit
+import logging
+import argparse
+import platform
+import subprocess
+import configparser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app')
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from solarmax import sm13MT2, communication, frameReader  # noqa: E402
+from simulator import inverterSimulator, faultProfile  # noqa: E402
+from mqttbroker import mqttStandIn  # noqa: E402
+from bench_decode import makeResponse  # noqa: E402
+
+
+def getRss():
+    # resident set size in kB, from /proc on linux and the peak value elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+def timeIt(func, number):
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    return {'us_per_call': round(best / number * 1e6, 3), 'calls': number}
+
+
+def benchMicro(number=20000):
+    con = communication('localhost', 0, autoconnect=False)
+    commands = list(sm13MT2.QUERY_MAP.keys())
+    plan = con.getPlan(commands)
+    chunk = plan.chunks[0]
+    response = makeResponse(chunk)
+    payload = response[1:-5]
+    frames = b''.join(makeResponse(c).encode('utf8') for c in plan.chunks)
+
+    def reassemble():
+        reader = frameReader()
+        for i in range(0, len(frames), 100):
+            reader.feed(frames[i:i + 100])
+            while reader.nextFrame() is not None:
+                pass
+
+    results = {
+        'calc_checksum': timeIt(lambda: con._calcChecksum(payload), number),
+        'validate_checksum': timeIt(lambda: con._validateChecksum(response), number),
+        'encode_request': timeIt(lambda: con._encodeRequest(chunk), number),
+        'get_plan': timeIt(lambda: con.getPlan(commands), number),
+        'decode': timeIt(lambda: con._decode(response), number),
+        'frame_reader': timeIt(reassemble, number // 10),
+    }
+
+    # a full query over loopback against the simulator
+    simulator = inverterSimulator(count=1, base_port=22345, seed=1)
+    simulator.startInThread()
+    try:
+        con = communication('127.0.0.1', 22345)
+        results['query'] = timeIt(lambda: con.query(commands), max(number // 100, 10))
+        con.disconnect()
+    finally:
+        simulator.stopThread()
+    return results
+
+
+# the cycle as it was done before the session and the shared publisher: new socket and new mqtt client each time
+def legacyCycle(config, commands):
+    import paho.mqtt.client as paho
+    con = communication(ip=config['INVERTER']['IP'], port=config['INVERTER']['Port'])
+    con.query(commands)
+    client = paho.Client("solarsmart")
+    client.connect(config['MQTT']['BrokerHostUri'], int(config['MQTT']['Port']))
+    for key, datapoint in con.getSample().toMessage().items():
+        client.publish(f"solarmax-sm13MT2/{key}", json.dumps(datapoint, default=str))
+
+
+def benchCycle(duration=30, legacy=False, faults=None, rss_interval=5.0):
+    from datalogger import dataLogger
+
+    simulator = inverterSimulator(count=1, base_port=22346, faults=faults, seed=1)
+    broker = mqttStandIn(port=18839)
+    simulator.startInThread()
+    broker.startInThread()
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join(APP_DIR, 'default.cfg'))
+    config['INVERTER']['IP'] = '127.0.0.1'
+    config['INVERTER']['Port'] = '22346'
+    config['MQTT']['BrokerHostUri'] = '127.0.0.1'
+    config['MQTT']['Port'] = '18839'
+
+    try:
+        if legacy:
+            commands = list(sm13MT2.QUERY_MAP.keys())
+            cycle = lambda: legacyCycle(config, commands)  # noqa: E731
+        else:
+            logger = dataLogger(config=config)
+            cycle = logger.logData
+
+        cycle()  # warm up, connects and fills the caches
+        rss_start = getRss()
+        rss = [(0.0, rss_start)]
+        latencies = []
+        started = time.perf_counter()
+        next_rss = started + rss_interval
+        while True:
+            t0 = time.perf_counter()
+            if t0 - started >= duration:
+                break
+            cycle()
+            latencies.append(time.perf_counter() - t0)
+            if t0 >= next_rss:
+                rss.append((round(t0 - started, 1), getRss()))
+                next_rss += rss_interval
+        elapsed = time.perf_counter() - started
+        time.sleep(0.5)  # let the publisher drain
+        if not legacy and logger.publisher is not None:
+            logger.publisher.stop()
+    finally:
+        simulator.stopThread()
+        broker.stopThread()
+
+    rss_end = getRss()
+    return {
+        'mode': 'legacy' if legacy else 'session',
+        'cycles': len(latencies),
+        'cycles_per_second': round(len(latencies) / elapsed, 1),
+        'latency_ms': {'p50': round(percentile(latencies, 50) * 1000, 3),
+                       'p99': round(percentile(latencies, 99) * 1000, 3),
+                       'max': round(max(latencies) * 1000, 3)},
+        'rss_kb': {'start': rss_start, 'end': rss_end, 'growth': rss_end - rss_start,
+                   'growth_per_1000_cycles': round((rss_end - rss_start) * 1000 / max(len(latencies), 1), 1),
+                   'samples': rss},
+        'mqtt': {'connects': broker.connects, 'messages': broker.messages, 'bytes': broker.bytes},
+        'inverter_requests': simulator.requests,
+    }
+
+
+def getVersion():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the poll-decode-publish path')
+    parser.add_argument('suite', choices=['micro', 'cycle', 'all'])
+    parser.add_argument('--duration', type=float, default=30, help='seconds per end-to-end run')
+    parser.add_argument('--number', type=int, default=20000, help='calls per micro benchmark')
+    parser.add_argument('--legacy', action='store_true', help='run the cycle the way it was done before')
+    parser.add_argument('--latency', type=float, default=0, help='simulated inverter latency in ms')
+    parser.add_argument('--split', type=float, default=0, help='probability of split inverter answers')
+    parser.add_argument('--output', default=None, help='write the json result to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    faults = faultProfile(latency=args.latency / 1000, split=args.split)
+    result = {'version': getVersion(), 'python': platform.python_version(), 'machine': platform.machine(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if args.suite in ('micro', 'all'):
+        result['micro'] = benchMicro(args.number)
+    if args.suite in ('cycle', 'all'):
+        result['cycle'] = [benchCycle(args.duration, legacy=args.legacy, faults=faults)]
+        if args.suite == 'all' and not args.legacy:
+            result['cycle'].append(benchCycle(args.duration, legacy=True, faults=faults))
+
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
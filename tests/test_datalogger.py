@@ -0,0 +1,64 @@
+# state handling of the data logger without inverter or broker:
+#   python3 -m unittest discover tests
+import os
+import sys
+import tempfile
+import unittest
+import configparser
+from datetime import datetime
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+from datalogger import dataLogger, loggerState  # noqa: E402
+from solarmax import communication  # noqa: E402
+
+
+class testZeroForcedLastSample(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        config = configparser.ConfigParser()
+        config.read(os.path.join(APP_DIR, 'default.cfg'))
+        config['MQTT']['Enable'] = 'False'
+        config['ROLLUP'] = {'Enable': 'True', 'Path': self.tmp.name}
+        config['PIPELINE'] = {'Enable': 'False'}
+        self.logger = dataLogger(config=config)
+        self.sunk = []
+        self.logger._dispatch = self.sunk.append
+        self.con = communication('localhost', 0, autoconnect=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _cycle(self, status, values=None):
+        self.con.decodeddata = values or {}
+        self.logger._handleStatus(status, self.con.getDeviceType())
+        self.logger._publish(self.con)
+        return self.logger.logger_state
+
+    def test_forced_sample_is_published_once_before_sleeping(self):
+        values = {'SDAT': datetime(2024, 6, 4, 12, 0), 'PAC': 1500.0, 'KDY': 4.2}
+        self.assertEqual(self._cycle(True, values), loggerState.LOGGING)
+        self.assertEqual(self._cycle(False), loggerState.LOGGING_LAST)
+        self.assertEqual(self._cycle(False), loggerState.SLEEPING)
+        self.assertEqual(self._cycle(False), loggerState.SLEEPING)
+
+        self.assertEqual([kind for kind, _, _ in self.sunk], ['sample', 'forced'])
+        forced = self.sunk[1][2]
+        self.assertEqual(forced.mod, 1)
+        self.assertEqual(forced.get('PAC'), 0.0)
+        self.assertEqual(forced.get('KDY'), 4.2)
+
+    def test_forced_sample_closes_the_short_rollup_windows(self):
+        self.logger._dispatch = self.logger._sink
+        self._cycle(True, {'SDAT': datetime(2024, 6, 4, 12, 0, 10), 'PAC': 1500.0})
+        self._cycle(True, {'SDAT': datetime(2024, 6, 4, 12, 0, 20), 'PAC': 1600.0})
+        closed = []
+        self.logger._sendRollups = lambda topic, windows: closed.extend(name for name, _ in windows)
+        self._cycle(False)
+        self.assertEqual(sorted(closed), ['15m', '1m'])
+
+
+if __name__ == '__main__':
+    unittest.main()
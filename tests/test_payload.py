@@ -0,0 +1,64 @@
+# compact cycle payload, cbor encoding against the decoder and known RFC 8949 encodings:
+#   python3 -m unittest discover tests
+import os
+import sys
+import unittest
+from datetime import datetime
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+from payload import encodeCbor, decodeCbor, cyclePayload  # noqa: E402
+from solarmax import sample  # noqa: E402
+
+
+class testCbor(unittest.TestCase):
+
+    def test_known_encodings(self):
+        # examples from RFC 8949 appendix A
+        self.assertEqual(encodeCbor(0), b'\x00')
+        self.assertEqual(encodeCbor(23), b'\x17')
+        self.assertEqual(encodeCbor(24), b'\x18\x18')
+        self.assertEqual(encodeCbor(1000), b'\x19\x03\xe8')
+        self.assertEqual(encodeCbor(-1), b'\x20')
+        self.assertEqual(encodeCbor(-1000), b'\x39\x03\xe7')
+        self.assertEqual(encodeCbor('a'), b'\x61a')
+        self.assertEqual(encodeCbor([1, [2, 3]]), b'\x82\x01\x82\x02\x03')
+        self.assertEqual(encodeCbor({'a': 1}), b'\xa1\x61a\x01')
+        self.assertEqual(encodeCbor(None), b'\xf6')
+        self.assertEqual(encodeCbor(True), b'\xf5')
+        self.assertEqual(encodeCbor(1.5), b'\xfa\x3f\xc0\x00\x00')
+
+    def test_round_trip(self):
+        values = [0, 23, 24, 255, 256, 65535, 65536, 2 ** 32, 2 ** 40, -1, -24, -25, -2 ** 40, 0.1, 1.5, -273.15,
+                  1e300, '', 'PAC', 'ü' * 30, b'\x00\xff', [], [1, 'x', [None, True, False]],
+                  {'t': 1717531200, 'mod': 0, 'v': {'PAC': 1234.5, 'SYS': '4E28,0'}}]
+        for value in values:
+            self.assertEqual(decodeCbor(encodeCbor(value)), value, repr(value))
+
+    def test_whole_floats_are_integers(self):
+        self.assertEqual(encodeCbor(2500.0), encodeCbor(2500))
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            encodeCbor(object())
+
+
+class testCyclePayload(unittest.TestCase):
+
+    def test_sample_round_trip(self):
+        sdat = datetime(2024, 6, 4, 12, 0)
+        current = sample.fromValues({'SDAT': sdat, 'PAC': 1234.5, 'KDY': 4.2, 'SYS': '4E28,0'}, 'roof')
+        body = decodeCbor(cyclePayload('cbor').encode(current))
+        self.assertEqual(body['t'], int(sdat.timestamp()))
+        self.assertEqual(body['mod'], 0)
+        self.assertEqual(body['v'], {'SDAT': int(sdat.timestamp()), 'PAC': 1234.5, 'KDY': 4.2, 'SYS': '4E28,0'})
+
+    def test_forced_zero_sample(self):
+        current = sample.fromValues({'SDAT': datetime(2024, 6, 4, 20, 0), 'PAC': 1234.5}, 'roof').forceZero()
+        body = decodeCbor(cyclePayload('cbor').encode(current))
+        self.assertEqual((body['mod'], body['v']['PAC']), (1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
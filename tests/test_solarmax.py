@@ -0,0 +1,141 @@
+# framing and decoding of inverter responses, fed with byte slices and strings directly:
+#   python3 -m unittest discover tests
+import os
+import sys
+import unittest
+from datetime import datetime
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+from solarmax import frameReader, responseDecoder, communication  # noqa: E402
+
+CON = communication('localhost', 0, autoconnect=False)
+
+
+def makeFrame(data, source='01', length=None):
+    body = f"{source};FB;{len(data) + 19 if length is None else length:02X}|64:{data}|"
+    return ('{' + body + CON._calcChecksum(body) + '}').encode('utf8')
+
+
+class testFrameReader(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = frameReader()
+        self.frame = makeFrame('PAC=2580;KDY=1E')
+
+    def _frames(self):
+        frames = []
+        frame = self.reader.nextFrame()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.reader.nextFrame()
+        return frames
+
+    def test_whole_frame(self):
+        self.reader.feed(self.frame)
+        self.assertEqual(self._frames(), [self.frame])
+        self.assertEqual(self.reader.pending(), 0)
+
+    def test_split_segments(self):
+        for cut in (1, 5, 12, len(self.frame) - 1):
+            reader = frameReader()
+            reader.feed(self.frame[:cut])
+            self.assertIsNone(reader.nextFrame(), f"cut at {cut}")
+            reader.feed(self.frame[cut:])
+            self.assertEqual(reader.nextFrame(), self.frame, f"cut at {cut}")
+
+    def test_byte_by_byte(self):
+        frames = []
+        for i in range(len(self.frame)):
+            self.reader.feed(self.frame[i:i + 1])
+            frames += self._frames()
+        self.assertEqual(frames, [self.frame])
+
+    def test_coalesced_frames(self):
+        other = makeFrame('UL1=8FC')
+        self.reader.feed(self.frame + other + self.frame[:10])
+        self.assertEqual(self._frames(), [self.frame, other])
+        self.reader.feed(self.frame[10:])
+        self.assertEqual(self._frames(), [self.frame])
+
+    def test_garbage_before_frame(self):
+        self.reader.feed(b'\x00\xffnoise}' + self.frame)
+        self.assertEqual(self._frames(), [self.frame])
+
+    def test_broken_header_resyncs_on_next_frame(self):
+        self.reader.feed(b'{zz|' + b'x' * 20 + self.frame)
+        self.assertEqual(self._frames(), [self.frame])
+
+    def test_length_field_does_not_match(self):
+        for length in (len(self.frame) - 3, len(self.frame) + 7):
+            reader = frameReader()
+            frame = makeFrame('PAC=2580;KDY=1E', length=length - 2)
+            reader.feed(frame + self.frame)
+            self.assertEqual(reader.nextFrame(), frame, f"length {length}")
+            self.assertEqual(reader.nextFrame(), self.frame, f"length {length}")
+
+    def test_buffer_is_bounded(self):
+        reader = frameReader(max_buffer=64)
+        reader.feed(b'{' + b'x' * 1000)
+        self.assertLessEqual(reader.pending(), 64)
+
+
+class testResponseDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = responseDecoder()
+
+    def test_scaled_values_and_datetime(self):
+        decoded = self.decoder.decode(makeFrame('PAC=2580;UL1=8FC;SDAT=7E5070F,B4F0;SYS=4E28,0').decode())
+        self.assertEqual(decoded['PAC'], 0x2580 / 2)
+        self.assertEqual(decoded['UL1'], round(0x8FC * 0.1, 3))
+        self.assertEqual(decoded['SDAT'], datetime(2021, 7, 15, 12, 52, 0))
+        self.assertEqual(decoded['SYS'], '4E28,0')
+
+    def test_unknown_fields(self):
+        decoded = self.decoder.decode(makeFrame('PAC=2580;XYZ=1;KDY=1E').decode())
+        self.assertEqual(set(decoded), {'PAC', 'KDY'})
+        self.assertEqual(self.decoder.unknown, ['XYZ=1'])
+        self.assertEqual(self.decoder.malformed, [])
+
+    def test_malformed_fields(self):
+        decoded = self.decoder.decode(makeFrame('PAC=zz;KDY;UL1=8FC;SDAT=7E5').decode())
+        self.assertEqual(set(decoded), {'UL1'})
+        self.assertEqual(sorted(self.decoder.malformed), ['KDY', 'PAC=zz', 'SDAT=7E5'])
+
+    def test_empty_payload(self):
+        self.assertEqual(self.decoder.decode(makeFrame('').decode()), {})
+        self.assertEqual(self.decoder.unknown, [])
+
+    def test_bad_format(self):
+        with self.assertRaises(ValueError):
+            self.decoder.decode('{01;FB;10|64')
+
+
+class testHandleResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.con = communication('localhost', 0, autoconnect=False)
+        self.con._beginQuery()
+
+    def test_answer_to_the_request(self):
+        self.assertTrue(self.con._handleResponse(makeFrame('PAC=2580').decode(), frozenset({'PAC'})))
+        self.assertIn('PAC', self.con.decodeddata)
+
+    def test_answer_to_another_request_is_stale(self):
+        self.assertIsNone(self.con._handleResponse(makeFrame('UL1=8FC').decode(), frozenset({'PAC'})))
+
+    def test_empty_answer_of_unsupported_keys(self):
+        self.assertTrue(self.con._handleResponse(makeFrame('').decode(), frozenset({'KDL'})))
+
+    def test_other_unit_is_stale(self):
+        self.assertIsNone(self.con._handleResponse(makeFrame('PAC=2580', source='02').decode(), frozenset({'PAC'})))
+
+    def test_bad_checksum(self):
+        frame = makeFrame('PAC=2580').decode()
+        self.assertFalse(self.con._handleResponse(frame[:-2] + '0}', frozenset({'PAC'})))
+
+
+if __name__ == '__main__':
+    unittest.main()